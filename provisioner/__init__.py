@@ -1,8 +1,24 @@
 import os
+from provisioner.cache import ModelCache
+from provisioner.clients import ClientRegistry
 from provisioner.database import Database
+from provisioner.models import JurisdictionType, ConfigurationTemplate
 
 db = Database(os.environ.get('DB_HOST'),
               os.environ.get('POSTGRES_DB'),
               os.environ.get('POSTGRES_USER'),
-              os.environ.get('POSTGRES_PASSWORD'))
+              os.environ.get('POSTGRES_PASSWORD'),
+              pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+              max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+              pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', -1)),
+              pool_pre_ping=os.environ.get('DB_POOL_PRE_PING') == 'true',
+              external_pooler=os.environ.get('DB_EXTERNAL_POOLER') == 'true',
+              replica_url=os.environ.get('DB_REPLICA_URL'),
+              max_replica_lag=float(os.environ.get('DB_REPLICA_MAX_LAG', 10)),
+              listen_url=os.environ.get('DB_LISTEN_URL'))
 
+model_cache = ModelCache(db,
+                         (JurisdictionType, ConfigurationTemplate),
+                         ttl=int(os.environ.get('CACHE_TTL', 300)))
+
+aws_clients = ClientRegistry(max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 10)))
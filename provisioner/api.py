@@ -1,49 +1,238 @@
+import hashlib
+import json
 import os
+import re
+import time
 
 import falcon
 import hug
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm.exc import NoResultFound
 
-from provisioner import db
-from provisioner.database import Database
+from provisioner import db, model_cache
+from provisioner.database import Database, JURISDICTION_CHANNEL
 from provisioner.models import JurisdictionType, Jurisdiction, ConfigurationTemplate
+from provisioner.models import Operation, Stack, WorkflowStep, stack_assets
 from provisioner.platforms import AWS
-from provisioner.tasks import monitor_cloudformation_stack
+from provisioner import tasks
 
 
-def get_objects(obj, obj_id, session):
-    """Retrieve objects from database"""
+def get_objects(obj, obj_id, session, limit=None, after_id=None, fields=None,
+                lineage=False):
+    """
+    Retrieve objects from database
+
+    Lists are ordered by id and may be paged with a limit and the id of the
+    last object on the previous page.  If fields are given, only those columns
+    are loaded from the database. Objects of cached models are served from
+    the cache rather than the database. With lineage, a jurisdiction is
+    loaded together with its ancestors and their types in one query.
+    """
+    if obj in model_cache.models:
+        return get_cached_objects(obj, obj_id, limit, after_id)
+
+    validate_limit(limit)
+
+    if lineage:
+        j = Jurisdiction.load_with_lineage(session, obj_id)
+        if j is None:
+            msg = "{0} with id {1} does not exist".format(obj.__name__, obj_id)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        return j
+
+    query = session.query(obj)
+    if fields:
+        columns = [obj.__attribute_columns__[f] for f in fields]
+        query = query.options(sqlalchemy.orm.load_only(*columns))
+    if obj is Jurisdiction:
+        query = load_stacks(query, fields)
 
     if obj_id:
         try:
-            query = session.query(obj).filter_by(id=obj_id).one()
+            query = query.filter_by(id=obj_id).one()
         except NoResultFound:
             msg = "{0} with id {1} does not exist".format(obj.__name__, obj_id)
             raise falcon.HTTPBadRequest('Bad request', msg)
     else:
-        query = session.query(obj).all()
+        if after_id:
+            query = query.filter(obj.id > after_id)
+        query = query.order_by(obj.id)
+        if limit:
+            query = query.limit(limit)
+        query = query.all()
 
     return query
 
 
-def get_object_attributes(obj, obj_id, session):
+def load_stacks(query, fields=None):
+    """
+    Load the stacks of the jurisdictions a query retrieves in the same query
+    when their assets, which include the stacks, are requested
+    """
+    if not fields or 'assets' in fields:
+        query = query.options(sqlalchemy.orm.joinedload(Jurisdiction.stacks))
+
+    return query
+
+
+def get_cached_objects(obj, obj_id, limit=None, after_id=None):
+    """Retrieve objects from the cache"""
+    validate_limit(limit)
+
+    if obj_id:
+        cached = model_cache.get(obj, obj_id)
+        if not cached:
+            msg = "{0} with id {1} does not exist".format(obj.__name__, obj_id)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        return cached
+
+    objects = model_cache.all(obj)
+    if after_id:
+        objects = [o for o in objects if o.id > after_id]
+    if limit:
+        objects = objects[:limit]
+
+    return objects
+
+
+def get_object_attributes(obj, obj_id, session, limit=None, after_id=None,
+                          fields=None):
     """Retrieve the attributes of an object"""
 
     if obj_id:
-        objects = [get_objects(obj, obj_id, session)]
+        objects = [get_objects(obj, obj_id, session, fields=fields)]
     else:
-        objects = get_objects(obj, obj_id, session)
+        objects = get_objects(obj, obj_id, session, limit, after_id, fields)
 
     object_attributes = []
     for o in objects:
-        object_attributes.append(o.__attributes__())
+        if fields:
+            object_attributes.append(o.__attributes__(fields))
+        else:
+            object_attributes.append(o.__attributes__())
 
     return object_attributes
 
 
+def returned_attributes(obj, row, session=None):
+    """
+    Retrieve the attributes of an object from a row returned by an INSERT or
+    UPDATE statement so that it need not be queried again. Given a session,
+    the stacks of an updated jurisdiction are included in its assets.
+    """
+    attributes = obj(**dict(row)).__attributes__()
+    if obj is Jurisdiction and session is not None:
+        stacks = session.query(Stack).filter_by(jurisdiction_id=row.id)\
+                        .order_by(Stack.id).all()
+        attributes['assets'] = stack_assets(attributes['assets'], stacks)
+
+    return attributes
+
+
+def validate_fields(obj, fields):
+    """
+    Ensure requested fields are attributes of the object.  The id is always
+    included so that clients can page through results.
+    """
+    if not fields:
+        return None
+
+    for field in fields:
+        if field not in obj.__attribute_columns__:
+            msg = '{0} is not a {1} attribute'.format(field, obj.__name__)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+    return set(fields) | {'id'}
+
+
+def validate_limit(limit):
+    """Ensure a requested page size, if any, is at least one object"""
+    if limit is not None and limit < 1:
+        msg = 'limit must be at least 1, not {}'.format(limit)
+        raise falcon.HTTPBadRequest('Bad request', msg)
+
+
+def page(data, limit):
+    """
+    Wrap a list of object attributes in a response. When the list is limited,
+    the id to request the next page after is included.
+    """
+    response = {'data': data}
+    if limit:
+        if len(data) == limit:
+            response['next_after_id'] = data[-1]['id']
+        else:
+            response['next_after_id'] = None
+
+    return response
+
+
+def last_updated(obj):
+    """
+    Build an expression for the time an object was last updated. A
+    jurisdiction is also updated when any of its stacks are.
+    """
+    if obj is Jurisdiction:
+        stacks_updated = sqlalchemy.select([sqlalchemy.func.max(Stack.updated_at)])\
+                                   .where(Stack.jurisdiction_id == Jurisdiction.id)\
+                                   .as_scalar()
+        return sqlalchemy.func.greatest(Jurisdiction.updated_on, stacks_updated)
+
+    return obj.updated_on
+
+
+def get_versions(obj, obj_id, session, limit=None, after_id=None):
+    """
+    Retrieve the id and update time of the objects get_objects would retrieve
+    without loading any of their other columns
+    """
+    validate_limit(limit)
+
+    query = session.query(obj.id, last_updated(obj))
+    if obj_id:
+        query = query.filter(obj.id == obj_id)
+    else:
+        if after_id:
+            query = query.filter(obj.id > after_id)
+        query = query.order_by(obj.id)
+        if limit:
+            query = query.limit(limit)
+
+    return query.all()
+
+
+def etag(*values):
+    """Generate a strong entity tag from the values that determine a response"""
+    digest = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8'))
+    return '"{}"'.format(digest.hexdigest())
+
+
+def not_modified(request, response, tag):
+    """
+    Set the ETag header of a response. If the request's If-None-Match header
+    matches the tag, the response status is set to 304 Not Modified and True
+    is returned so that the handler can return without building a body.
+    """
+    if response is None:
+        return False
+
+    response.set_header('ETag', tag)
+
+    if request is not None:
+        if_none_match = request.get_header('If-None-Match')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if tag in tags or '*' in tags:
+                response.status = falcon.HTTP_304
+                return True
+
+    return False
+
+
 @hug.get('/get_jurisdiction_types/', version=1)
-def get_jurisdiction_types(jurisdiction_type_id: hug.types.number=None):
+def get_jurisdiction_types(jurisdiction_type_id: hug.types.number=None,
+                           request=None, response=None):
     """
     A jurisdiciton is a group of instructure resources that have a particular
     extent of operation and control. Jurisdictions of different types may be
@@ -64,49 +253,317 @@ def get_jurisdiction_types(jurisdiction_type_id: hug.types.number=None):
     It is possible to create and define more jurisdiction types in addition
     to the defaults listed above. This handler returns jurisdiction types currently
     in the system.
+
+    Responses include an ETag header. If it is sent back in an If-None-Match
+    header and the jurisdiction types have not changed, 304 Not Modified is
+    returned without a body.
     """
-    with db.transaction() as session:
-        jt_attrs = get_object_attributes(JurisdictionType,
-                                         jurisdiction_type_id,
-                                         session)
+    tag = etag(model_cache.version(JurisdictionType), jurisdiction_type_id)
+    if not_modified(request, response, tag):
+        return
+
+    # served from the cache without a database transaction
+    jt_attrs = get_object_attributes(JurisdictionType, jurisdiction_type_id, None)
 
     return {'data': jt_attrs}
 
 
 @hug.get('/get_configuration_templates/', version=1)
-def get_configuration_templates(configuration_template_id: hug.types.number=None):
+def get_configuration_templates(configuration_template_id: hug.types.number=None,
+                                request=None, response=None):
     """
     A configuration template defines the default configuration values for a
     jurisdiction type.
 
     This handler returns the configuration templates currently in the system.
+
+    Responses include an ETag header. If it is sent back in an If-None-Match
+    header and the templates have not changed, 304 Not Modified is returned
+    without a body.
     """
-    with db.transaction() as session:
-        ct_attrs = get_object_attributes(ConfigurationTemplate,
-                                         configuration_template_id,
-                                         session)
+    tag = etag(model_cache.version(ConfigurationTemplate), configuration_template_id)
+    if not_modified(request, response, tag):
+        return
+
+    # served from the cache without a database transaction
+    ct_attrs = get_object_attributes(ConfigurationTemplate, configuration_template_id, None)
 
     return {'data': ct_attrs}
 
 
 @hug.get('/get_jurisdictions/', version=1)
-def get_jurisdictions(jurisdiction_id: hug.types.number=None):
+def get_jurisdictions(jurisdiction_id: hug.types.number=None,
+                      limit: hug.types.number=None,
+                      after_id: hug.types.number=None,
+                      fields: hug.types.comma_separated_list=None,
+                      request=None, response=None):
     """
     A jurisdiciton is a group of instructure resources that have a particular
     extent of operation and control. Jurisdictions of different types may be
     nested within one another with nested jurisdictions have narrower extent
     of operation and control.
 
-    This handler returns the jurisdictions currently in the system.
+    This handler returns the jurisdictions currently in the system. Each
+    jurisdiction's effective_configuration is its configuration merged over
+    the configurations of the jurisdictions it is nested within.
+
+    Jurisdictions are returned in order of id. To page through them, provide
+    a limit and pass the returned next_after_id as after_id to get the next
+    page. To reduce the size of the response, provide a comma separated list
+    of fields, e.g. fields=name,active, and only those attributes (plus id)
+    are returned. Unrequested columns such as configuration and assets are
+    not loaded from the database.
+
+    Responses include an ETag header derived from the update times of the
+    jurisdictions returned. If it is sent back in an If-None-Match header and
+    none of them have changed, 304 Not Modified is returned without a body.
+
+    When a read replica is configured, jurisdictions are read from it and may
+    lag recent changes by up to the configured maximum replica lag.
     """
-    with db.transaction() as session:
+    fields = validate_fields(Jurisdiction, fields)
+
+    with db.transaction(readonly=True) as session:
+        versions = get_versions(Jurisdiction, jurisdiction_id, session, limit, after_id)
+        tag = etag(versions, sorted(fields or []), limit)
+        if not_modified(request, response, tag):
+            return
+
         j_attrs = get_object_attributes(Jurisdiction,
                                         jurisdiction_id,
-                                        session)
+                                        session,
+                                        limit,
+                                        after_id,
+                                        fields)
+
+    if jurisdiction_id:
+        return {'data': j_attrs}
+
+    return page(j_attrs, limit)
+
+
+def subtree_query(session, entities, jurisdiction_id, depth=None,
+                  jurisdiction_type_id=None):
+    """
+    Build a query for a jurisdiction and its descendants using a single
+    recursive query on parent_id. Each result is the requested entities
+    followed by the depth below the jurisdiction, ordered by depth and id.
+    """
+    tree = session.query(Jurisdiction.id,
+                         sqlalchemy.literal(0, sqlalchemy.Integer).label('depth'))\
+                  .filter(Jurisdiction.id == jurisdiction_id)\
+                  .cte(name='tree', recursive=True)
+
+    child = sqlalchemy.orm.aliased(Jurisdiction, name='child')
+    descendants = session.query(child.id, (tree.c.depth + 1).label('depth'))\
+                         .filter(child.parent_id == tree.c.id)
+    if depth is not None:
+        descendants = descendants.filter(tree.c.depth < depth)
+    tree = tree.union_all(descendants)
+
+    query = session.query(*(entities + (tree.c.depth,)))\
+                   .join(tree, Jurisdiction.id == tree.c.id)
+    if jurisdiction_type_id:
+        query = query.filter(Jurisdiction.jurisdiction_type_id == jurisdiction_type_id)
+
+    return query.order_by(tree.c.depth, Jurisdiction.id)
+
+
+def get_subtree(jurisdiction_id, session, depth=None, jurisdiction_type_id=None,
+                fields=None):
+    """
+    Retrieve a jurisdiction and its descendants. Returns (jurisdiction, depth)
+    tuples ordered by depth and id.
+    """
+    query = subtree_query(session, (Jurisdiction,), jurisdiction_id, depth,
+                          jurisdiction_type_id)
+    if fields:
+        columns = [Jurisdiction.__attribute_columns__[f] for f in fields]
+        query = query.options(sqlalchemy.orm.load_only(*columns))
+
+    return load_stacks(query, fields).all()
+
+
+@hug.get('/get_jurisdiction_tree/', version=1)
+def get_jurisdiction_tree(jurisdiction_id: hug.types.number,
+                          depth: hug.types.number=None,
+                          jurisdiction_type_id: hug.types.number=None,
+                          fields: hug.types.comma_separated_list=None,
+                          request=None, response=None):
+    """
+    A jurisdiciton is a group of instructure resources that have a particular
+    extent of operation and control. Jurisdictions of different types may be
+    nested within one another with nested jurisdictions have narrower extent
+    of operation and control.
+
+    This handler returns a jurisdiction and all the jurisdictions nested
+    within it, e.g. a control group, its tiers and their clusters. Each
+    jurisdiction includes its depth below the requested jurisdiction and they
+    are ordered by depth then id. The tree can be limited to a number of
+    levels with depth and to a particular type with jurisdiction_type_id.
+    Fields may be given to limit the attributes returned as with
+    get_jurisdictions. Responses include an ETag header and conditional
+    requests are handled as with get_jurisdictions.
+    """
+    fields = validate_fields(Jurisdiction, fields)
+
+    with db.transaction(readonly=True) as session:
+        versions = subtree_query(session, (Jurisdiction.id, last_updated(Jurisdiction)),
+                                 jurisdiction_id, depth, jurisdiction_type_id).all()
+        tag = etag(versions, sorted(fields or []))
+        if not_modified(request, response, tag):
+            return
+
+        subtree = get_subtree(jurisdiction_id, session, depth,
+                              jurisdiction_type_id, fields)
+        if not subtree:
+            # raises if the requested jurisdiction does not exist
+            get_objects(Jurisdiction, jurisdiction_id, session, fields=['id'])
+
+        j_attrs = []
+        for j, j_depth in subtree:
+            if fields:
+                attrs = j.__attributes__(fields)
+            else:
+                attrs = j.__attributes__()
+            attrs['depth'] = j_depth
+            j_attrs.append(attrs)
 
     return {'data': j_attrs}
 
 
+class TxidSnapshot(sqlalchemy.types.UserDefinedType):
+    """The Postgres type of transaction snapshots used as change cursors"""
+    def get_col_spec(self):
+        return 'txid_snapshot'
+
+
+# the text form of a transaction snapshot: xmin:xmax:xip,...
+CURSOR_PATTERN = re.compile(r'^\d+:\d+:(\d+(,\d+)*)?$')
+
+
+def changed_since(txid, snapshot):
+    """
+    Build a filter on rows last changed by a transaction whose changes were
+    not visible in a snapshot, i.e. that had not committed when it was
+    taken. The lower bound on the transaction id lets the filter use an
+    index.
+    """
+    return sqlalchemy.and_(txid >= sqlalchemy.func.txid_snapshot_xmin(snapshot),
+                           sqlalchemy.not_(sqlalchemy.func.txid_visible_in_snapshot(
+                                               txid, snapshot)))
+
+
+def get_statuses(session, since=None, jurisdiction_id=None):
+    """
+    Retrieve the id, activity, version and stack statuses of jurisdictions
+    changed since a cursor, ordered by update time, along with a new cursor.
+    The stack statuses are aggregated from the stack table in the same query.
+
+    A cursor is the snapshot of the transaction that read the statuses, so a
+    jurisdiction or stack changed by a transaction that had not committed
+    when the cursor was taken is retrieved with the next cursor however
+    transactions interleave and whatever the clocks of the hosts that made
+    the changes.
+    """
+    # the statuses and the cursor are read from one snapshot
+    session.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    cursor = session.execute('SELECT txid_current_snapshot()::text').scalar()
+
+    updated_on = last_updated(Jurisdiction)
+    stacks = sqlalchemy.select([sqlalchemy.func.json_object_agg(Stack.key, Stack.status)])\
+                       .where(Stack.jurisdiction_id == Jurisdiction.id)\
+                       .as_scalar()
+    query = session.query(Jurisdiction.id,
+                          Jurisdiction.active,
+                          Jurisdiction.version,
+                          stacks.label('stacks'),
+                          updated_on.label('updated_on'))
+    if since:
+        snapshot = sqlalchemy.cast(since, TxidSnapshot())
+        changed = sqlalchemy.union(
+                      sqlalchemy.select([Jurisdiction.id])
+                                .where(changed_since(Jurisdiction.txid, snapshot)),
+                      sqlalchemy.select([Stack.jurisdiction_id])
+                                .where(changed_since(Stack.txid, snapshot)))
+        query = query.filter(Jurisdiction.id.in_(changed))
+    if jurisdiction_id:
+        query = query.filter(Jurisdiction.id == jurisdiction_id)
+
+    statuses = []
+    for row in query.order_by(updated_on):
+        statuses.append({
+            'id': row.id,
+            'active': row.active,
+            'version': row.version,
+            'stacks': row.stacks or {},
+            'updated_on': row.updated_on
+        })
+
+    return statuses, cursor
+
+
+@hug.get('/watch_jurisdictions/', version=1)
+def watch_jurisdictions(since: hug.types.text=None,
+                        jurisdiction_id: hug.types.number=None,
+                        timeout: hug.types.number=25):
+    """
+    A jurisdiciton is a group of instructure resources that have a particular
+    extent of operation and control. Jurisdictions of different types may be
+    nested within one another with nested jurisdictions have narrower extent
+    of operation and control.
+
+    This handler allows clients to wait for jurisdictions to change instead
+    of repeatedly requesting them. It returns the id, active attribute,
+    version and cloudformation stack statuses of the jurisdictions that have
+    changed since the given cursor, along with a new cursor to pass as since
+    in the next request. Cursors are opaque. If none have changed, the
+    request is held open for up to timeout seconds (at most 55) until one
+    does and an empty list is returned if none do. Changes are pushed to the
+    handler by the database so no polling takes place while waiting. Without
+    a cursor the current status of the jurisdictions is returned immediately.
+    Changes can be limited to one jurisdiction with jurisdiction_id.
+
+    Every change committed after a cursor was returned is included in a
+    later response. A jurisdiction may be returned again without having
+    changed, e.g. when only another of its stacks changed, so clients should
+    compare the id, version and stacks with those they have already seen.
+    """
+    if since and not CURSOR_PATTERN.match(since):
+        msg = '{} is not a valid cursor'.format(since)
+        raise falcon.HTTPBadRequest('Bad request', msg)
+
+    if not since:
+        with db.transaction() as session:
+            statuses, cursor = get_statuses(session, since, jurisdiction_id)
+    else:
+        # listen before checking so no change is missed in between
+        deadline = time.time() + min(max(timeout, 0), 55)
+        with db.listen(JURISDICTION_CHANNEL) as feed:
+            with db.transaction() as session:
+                statuses, cursor = get_statuses(session, since, jurisdiction_id)
+
+            while not statuses and time.time() < deadline:
+                changes = feed.wait(max(deadline - time.time(), 0))
+                # check again if changes may have been missed
+                if changes is None or \
+                   any(not jurisdiction_id or c.get('id') == jurisdiction_id for c in changes):
+                    with db.transaction() as session:
+                        statuses, cursor = get_statuses(session, since, jurisdiction_id)
+
+    return {'data': statuses, 'cursor': cursor}
+
+
+# the names Postgres gives the constraints on jurisdiction names and parents
+NAME_CONSTRAINT = 'jurisdiction_name_key'
+PARENT_CONSTRAINT = 'jurisdiction_parent_id_fkey'
+
+
+def violated_constraint(error):
+    """Return the name of the constraint an IntegrityError violated"""
+    return error.orig.diag.constraint_name
+
+
 @hug.post('/create_jurisdiction/', version=1)
 def create_jurisdiction(jurisdiction_name: hug.types.text,
                         jurisdiction_type_id: hug.types.number,
@@ -129,37 +586,224 @@ def create_jurisdiction(jurisdiction_name: hug.types.text,
     jurisdiction may be provisioned which actually stands up the infrastructure
     required.
     """
+    jurisdiction_type = get_cached_objects(JurisdictionType, jurisdiction_type_id)
+    configuration_template = get_cached_objects(ConfigurationTemplate,
+                                                configuration_template_id)
+    if configuration_template.jurisdiction_type_id != jurisdiction_type.id:
+        msg = """
+            ConfigurationTemplate with id {0} is not a template for
+            JurisdictionType '{1}'
+        """.format(configuration_template_id, jurisdiction_type.name)
+        raise falcon.HTTPBadRequest('Bad request', ' '.join(msg.split()))
+
+    # no row is returned if the name is already taken
+    jurisdiction_table = Jurisdiction.__table__
+    insert = postgresql.insert(jurisdiction_table)\
+                       .values(name=jurisdiction_name,
+                               jurisdiction_type_id=jurisdiction_type.id,
+                               configuration=configuration_template.configuration,
+                               parent_id=parent_id)\
+                       .on_conflict_do_nothing(index_elements=['name'])\
+                       .returning(*jurisdiction_table.c)
+
     with db.transaction() as session:
-        name_exists = session.query(sqlalchemy.sql.exists().where(
-                            Jurisdiction.name == jurisdiction_name)).scalar()
-        if name_exists:
+        try:
+            row = session.execute(insert).first()
+        except sqlalchemy.exc.IntegrityError as e:
+            if violated_constraint(e) != PARENT_CONSTRAINT:
+                raise
+            msg = "Jurisdiction with id {} does not exist".format(parent_id)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        if row is None:
             msg = "Jurisdiction '{}' already exists".format(jurisdiction_name)
             raise falcon.HTTPBadRequest('Bad request', msg)
 
-        jurisdiction_type = get_objects(JurisdictionType,
-                                        jurisdiction_type_id,
-                                        session)
-        configuration_template = get_objects(ConfigurationTemplate,
-                                             configuration_template_id,
-                                             session)
-        if configuration_template.jurisdiction_type_id != jurisdiction_type.id:
-            msg = """
-                ConfigurationTemplate with id {0} is not a template for
-                JurisdictionType '{1}'
-            """.format(configuration_template_id, jurisdiction_type.name)
-            raise falcon.HTTPBadRequest('Bad request', ' '.join(msg.split()))
-        if parent_id:
-            parent = get_objects(Jurisdiction, parent_id, session)
-
-        new_jurisdiction = Jurisdiction(name=jurisdiction_name,
-                                        jurisdiction_type_id=jurisdiction_type.id,
-                                        configuration=configuration_template.configuration,
-                                        parent_id=parent_id)
-        session.add(new_jurisdiction)
+        data = returned_attributes(Jurisdiction, row)
+
+    return {'data': data}
+
+
+# the type of each value a jurisdiction in a create_jurisdictions request may
+# have and whether it is required
+JURISDICTION_SPEC = {
+    'jurisdiction_name':         (str, True),
+    'jurisdiction_type_id':      (int, True),
+    'configuration_template_id': (int, True),
+    'parent_id':                 (int, False),
+    'parent_name':               (str, False)
+}
+
+
+def validate_spec(index, spec):
+    """
+    Ensure the values of a jurisdiction in a create_jurisdictions request
+    are known and of the right type so that none reaches the database as an
+    invalid value, and that its parent is given only once. The
+    jurisdiction's index is included in the error.
+    """
+    for key, value in spec.items():
+        if key not in JURISDICTION_SPEC:
+            msg = 'Jurisdiction {0}: {1} is not a jurisdiction value'.format(index, key)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        value_type, required = JURISDICTION_SPEC[key]
+        if value is None and not required:
+            continue
+        # bools are ints in python but never valid ids
+        if not isinstance(value, value_type) or isinstance(value, bool):
+            msg = 'Jurisdiction {0}: {1} must be {2}'.format(
+                      index, key, 'an integer' if value_type is int else 'a string')
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+    if spec.get('parent_id') is not None and spec.get('parent_name') is not None:
+        msg = 'Jurisdiction {}: only one of parent_id and parent_name may be given'.format(index)
+        raise falcon.HTTPBadRequest('Bad request', msg)
+
+
+@hug.post('/create_jurisdictions/', version=1)
+def create_jurisdictions(body):
+    """
+    A jurisdiciton is a group of instructure resources that have a particular
+    extent of operation and control. Jurisdictions of different types may be
+    nested within one another with nested jurisdictions have narrower extent
+    of operation and control.
+
+    This handler allows the user to create many jurisdictions at once. The
+    request body is a JSON list of jurisdictions each with the same values
+    that create_jurisdiction takes:
+        [
+            {
+                "jurisdiction_name": "alpha_dev",
+                "jurisdiction_type_id": 2,
+                "configuration_template_id": 2,
+                "parent_id": 1
+            },
+            {
+                "jurisdiction_name": "alpha_dev_01",
+                "jurisdiction_type_id": 3,
+                "configuration_template_id": 3,
+                "parent_name": "alpha_dev"
+            }
+        ]
+    Instead of a parent_id, a parent_name may be given which refers to either
+    an existing jurisdiction or one created in the same request.
+
+    All of the jurisdictions are created in a single transaction so either
+    all of them are created or, if any is invalid, none are. The created
+    jurisdictions are returned in the order given.
+    """
+    if not isinstance(body, list) or not body:
+        msg = 'Request body must be a list of jurisdictions'
+        raise falcon.HTTPBadRequest('Bad request', msg)
+
+    required = ('jurisdiction_name', 'jurisdiction_type_id', 'configuration_template_id')
+    for index, spec in enumerate(body):
+        if not isinstance(spec, dict) or not all(r in spec for r in required):
+            msg = 'Jurisdiction {0} requires {1}'.format(index, ', '.join(required))
+            raise falcon.HTTPBadRequest('Bad request', msg)
+        validate_spec(index, spec)
+
+    names = [spec['jurisdiction_name'] for spec in body]
+    for name in names:
+        if names.count(name) > 1:
+            msg = "Jurisdiction '{}' is included more than once".format(name)
+            raise falcon.HTTPBadRequest('Bad request', msg)
 
     with db.transaction() as session:
-        jurisdiction = session.query(Jurisdiction).filter_by(name=jurisdiction_name)[0]
-        data = jurisdiction.__attributes__()
+        existing = session.query(Jurisdiction.name)\
+                          .filter(Jurisdiction.name.in_(names)).first()
+        if existing:
+            msg = "Jurisdiction '{}' already exists".format(existing.name)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        # resolve existing parents once for the batch
+        parent_ids = set(spec['parent_id'] for spec in body if spec.get('parent_id'))
+        parent_names = set(spec['parent_name'] for spec in body
+                           if spec.get('parent_name') and spec['parent_name'] not in names)
+        parent_filters = []
+        if parent_ids:
+            parent_filters.append(Jurisdiction.id.in_(parent_ids))
+        if parent_names:
+            parent_filters.append(Jurisdiction.name.in_(parent_names))
+        parents = session.query(Jurisdiction.id, Jurisdiction.name)\
+                         .filter(sqlalchemy.or_(*parent_filters))\
+                         .all() if parent_filters else []
+        existing_parent_ids = set(p.id for p in parents)
+        parent_ids_by_name = {p.name: p.id for p in parents}
+
+        # allocate ids up front so parents in the batch can be referenced
+        new_ids = [row[0] for row in session.execute(
+                        "SELECT nextval('jurisdiction_id_seq') FROM generate_series(1, :n)",
+                        {'n': len(body)})]
+        parent_ids_by_name.update(zip(names, new_ids))
+
+        rows = []
+        for new_id, spec in zip(new_ids, body):
+            jurisdiction_type = model_cache.get(JurisdictionType, spec['jurisdiction_type_id'])
+            if not jurisdiction_type:
+                msg = "JurisdictionType with id {} does not exist".format(
+                                                    spec['jurisdiction_type_id'])
+                raise falcon.HTTPBadRequest('Bad request', msg)
+
+            configuration_template = model_cache.get(ConfigurationTemplate,
+                                                     spec['configuration_template_id'])
+            if not configuration_template:
+                msg = "ConfigurationTemplate with id {} does not exist".format(
+                                                    spec['configuration_template_id'])
+                raise falcon.HTTPBadRequest('Bad request', msg)
+            if configuration_template.jurisdiction_type_id != jurisdiction_type.id:
+                msg = """
+                    ConfigurationTemplate with id {0} is not a template for
+                    JurisdictionType '{1}'
+                """.format(configuration_template.id, jurisdiction_type.name)
+                raise falcon.HTTPBadRequest('Bad request', ' '.join(msg.split()))
+
+            parent_id = spec.get('parent_id')
+            if parent_id and parent_id not in existing_parent_ids:
+                msg = "Jurisdiction with id {} does not exist".format(parent_id)
+                raise falcon.HTTPBadRequest('Bad request', msg)
+            if spec.get('parent_name'):
+                parent_id = parent_ids_by_name.get(spec['parent_name'])
+                if not parent_id:
+                    msg = "Jurisdiction '{}' does not exist".format(spec['parent_name'])
+                    raise falcon.HTTPBadRequest('Bad request', msg)
+
+            rows.append({
+                'id': new_id,
+                'name': spec['jurisdiction_name'],
+                'jurisdiction_type_id': jurisdiction_type.id,
+                'configuration': configuration_template.configuration,
+                'parent_id': parent_id
+            })
+
+        # insert parents before their children so that the database can
+        # derive each child's path from its parent's
+        ordered_rows = []
+        inserted_ids = set()
+        while len(ordered_rows) < len(rows):
+            ready = [row for row in rows if row['id'] not in inserted_ids and
+                     (row['parent_id'] not in new_ids or row['parent_id'] in inserted_ids)]
+            if not ready:
+                msg = 'Jurisdictions cannot be nested within themselves'
+                raise falcon.HTTPBadRequest('Bad request', msg)
+            ordered_rows.extend(ready)
+            inserted_ids.update(row['id'] for row in ready)
+
+        # names are checked above but may be taken by a concurrent request
+        # before the insert
+        try:
+            session.execute(Jurisdiction.__table__.insert().values(ordered_rows))
+        except sqlalchemy.exc.IntegrityError as e:
+            if violated_constraint(e) != NAME_CONSTRAINT:
+                raise
+            msg = 'A jurisdiction in the request was created by another request'
+            raise falcon.HTTPConflict('Conflict', msg)
+
+        jurisdictions = load_stacks(session.query(Jurisdiction))\
+                               .filter(Jurisdiction.id.in_(new_ids))\
+                               .order_by(Jurisdiction.id).all()
+        data = [j.__attributes__() for j in jurisdictions]
 
     return {'data': data}
 
@@ -179,25 +823,152 @@ def edit_jurisdiction(jurisdiction_id: hug.types.number, **edits):
     if 'metadata' in edits:
         edits['jurisdiction_metadata'] = edits.pop('metadata')
 
+    for attr in edits:
+        if attr not in ('name', 'jurisdiction_metadata', 'configuration'):
+            msg = '{} is not a Jurisdiction attribute that can be edited'.format(attr)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+    if not edits:
+        with db.transaction() as session:
+            data = get_objects(Jurisdiction, jurisdiction_id, session).__attributes__()
+        return {'data': data}
+
+    jurisdiction_table = Jurisdiction.__table__
+    update = jurisdiction_table.update()\
+                               .where(jurisdiction_table.c.id == jurisdiction_id)\
+                               .values(version=jurisdiction_table.c.version + 1,
+                                       **edits)\
+                               .returning(*jurisdiction_table.c)
+
     with db.transaction() as session:
-        jurisdiction = get_objects(Jurisdiction, jurisdiction_id, session)
+        try:
+            row = session.execute(update).first()
+        except sqlalchemy.exc.IntegrityError as e:
+            if violated_constraint(e) != NAME_CONSTRAINT:
+                raise
+            msg = "Jurisdiction '{}' already exists".format(edits.get('name'))
+            raise falcon.HTTPBadRequest('Bad request', msg)
 
-        for attr in edits:
-            if attr in ('name', 'jurisdiction_metadata', 'configuration'):
-                jurisdiction.__setattr__(attr, edits[attr])
-            else:
-                msg = '{} is not a Jurisdiction attribute that can be edited'.format(attr)
-                raise falcon.HTTPBadRequest('Bad request', msg)
+        if row is None:
+            msg = "Jurisdiction with id {} does not exist".format(jurisdiction_id)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        data = returned_attributes(Jurisdiction, row, session)
+
+    return {'data': data}
+
+
+def remove_nulls(patch):
+    """Remove keys with null values from a merge patch recursively"""
+    return {k: remove_nulls(v) if isinstance(v, dict) else v
+            for k, v in patch.items() if v is not None}
+
+
+def merge_patch_expression(target, patch):
+    """
+    Compile a JSON merge patch (RFC 7386) into a jsonb expression that applies
+    the patch to the target within the database. Keys with null values are
+    removed, objects are merged recursively and other values replace the
+    target's values.
+    """
+    expression = target
+    replacements = {}
+    for key, value in patch.items():
+        if value is None:
+            expression = sqlalchemy.type_coerce(
+                                expression.op('-')(sqlalchemy.literal(key, sqlalchemy.Text)),
+                                postgresql.JSONB)
+        elif isinstance(value, dict):
+            child = target[key]
+            merged = sqlalchemy.case(
+                        [(sqlalchemy.func.jsonb_typeof(child) == 'object',
+                          merge_patch_expression(child, value))],
+                        else_=sqlalchemy.literal(remove_nulls(value), postgresql.JSONB))
+            path = sqlalchemy.literal([key], postgresql.ARRAY(sqlalchemy.Text))
+            expression = sqlalchemy.type_coerce(
+                                sqlalchemy.func.jsonb_set(expression, path, merged),
+                                postgresql.JSONB)
+        else:
+            replacements[key] = value
+
+    if replacements:
+        expression = sqlalchemy.type_coerce(
+                            expression.op('||')(sqlalchemy.literal(replacements,
+                                                                   postgresql.JSONB)),
+                            postgresql.JSONB)
+
+    return expression
+
+
+@hug.patch('/patch_jurisdiction_configuration/', version=1)
+def patch_jurisdiction_configuration(jurisdiction_id: hug.types.number, body):
+    """
+    A jurisdiciton is a group of instructure resources that have a particular
+    extent of operation and control. Jurisdictions of different types may be
+    nested within one another with nested jurisdictions have narrower extent
+    of operation and control.
+
+    This handler allows the user to change part of a jurisdiction's
+    configuration without sending the whole configuration. The request body
+    is a JSON merge patch (RFC 7386) of the configuration, e.g.
+        {"initial_workers": 3, "etcd_ips": null}
+    sets initial_workers to 3 and removes etcd_ips. Nested objects are merged
+    and all other keys are left as they are. The patch is applied by the
+    database so concurrent patches of different keys are not lost.
+    """
+    if not isinstance(body, dict) or not body:
+        msg = 'Request body must be a JSON merge patch object'
+        raise falcon.HTTPBadRequest('Bad request', msg)
+
+    jurisdiction_table = Jurisdiction.__table__
+    update = jurisdiction_table.update()\
+                               .where(jurisdiction_table.c.id == jurisdiction_id)\
+                               .values(configuration=merge_patch_expression(
+                                            jurisdiction_table.c.configuration, body),
+                                       version=jurisdiction_table.c.version + 1)\
+                               .returning(*jurisdiction_table.c)
 
     with db.transaction() as session:
-        jurisdiction = session.query(Jurisdiction).filter_by(id=jurisdiction_id)[0]
-        data = jurisdiction.__attributes__()
+        row = session.execute(update).first()
+
+        if row is None:
+            msg = "Jurisdiction with id {} does not exist".format(jurisdiction_id)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        data = returned_attributes(Jurisdiction, row, session)
 
     return {'data': data}
 
 
+def lock_jurisdiction(session, jurisdiction_id):
+    """
+    Take the lock of a jurisdiction whose infrastructure is about to change
+    for the rest of the session's transaction. If another request or worker
+    holds it, 409 Conflict is returned instead of waiting.
+    """
+    if not db.try_lock_jurisdiction(session, jurisdiction_id):
+        msg = 'Jurisdiction with id {} is being provisioned or decommissioned'.format(jurisdiction_id)
+        raise falcon.HTTPConflict('Conflict', msg)
+
+
+def check_operations(session, jurisdiction_id):
+    """
+    Return 409 Conflict if an operation on a jurisdiction is in progress. A
+    running operation changes the jurisdiction's infrastructure without
+    holding its lock while its platform is called.
+    """
+    in_progress = session.query(Operation.id)\
+                         .filter(Operation.jurisdiction_id == jurisdiction_id,
+                                 Operation.status.in_(('pending', 'running')))\
+                         .first()
+    if in_progress:
+        msg = 'Operation with id {0} on jurisdiction with id {1} is in progress'.format(
+                  in_progress.id, jurisdiction_id)
+        raise falcon.HTTPConflict('Conflict', msg)
+
+
 @hug.put('/provision_jurisdiction/', version=1)
-def provision_jurisdiction(jurisdiction_id: hug.types.number):
+def provision_jurisdiction(jurisdiction_id: hug.types.number, response=None):
     """
     A jurisdiciton is a group of instructure resources that have a particular
     extent of operation and control. Jurisdictions of different types may be
@@ -206,59 +977,105 @@ def provision_jurisdiction(jurisdiction_id: hug.types.number):
 
     This handler provisions the infrastructure after a jurisdiction has been
     created and edited as needed.
+
+    Provisioning is carried out by a worker. The handler validates the request
+    and responds immediately with 202 Accepted and a provisioning operation.
+    Its progress can be followed with get_operation. Once the operation is
+    complete the jurisdiction's assets are available and the jurisdiction is
+    marked active when its infrastructure is ready. A cluster's operation is
+    complete once its provisioning workflow has started and is failed
+    afterwards if a step of the workflow fails.
+
+    If the jurisdiction is already being provisioned or decommissioned,
+    including while its stacks are being created or the steps of its
+    workflow are running after its provisioning operation is complete, 409
+    Conflict is returned. Different jurisdictions
+    may be provisioned at the same time.
     """
     with db.transaction() as session:
-        j = get_objects(Jurisdiction, jurisdiction_id, session)
+        lock_jurisdiction(session, jurisdiction_id)
+        j = get_objects(Jurisdiction, jurisdiction_id, session, lineage=True)
 
         if j.active == True:
             msg = 'Jurisdiction with id {} is already active'.format(jurisdiction_id)
             raise falcon.HTTPBadRequest('Bad request', msg)
 
-        jurisdiction_type = j.jurisdiction_type.name
+        check_operations(session, j.id)
+
+        # an operation completes once the creation of its stacks has started,
+        # so they may still be being created by cloudformation or a workflow
+        creating = session.query(Stack.key)\
+                          .filter(Stack.jurisdiction_id == j.id, tasks.in_progress())\
+                          .first()
+        if creating:
+            msg = 'Stack {0} of jurisdiction with id {1} is in progress'.format(
+                      creating.key, jurisdiction_id)
+            raise falcon.HTTPConflict('Conflict', msg)
+
+        step = tasks.unfinished_steps(session, j.id).first()
+        if step:
+            msg = 'Workflow {0} of jurisdiction with id {1} is in progress'.format(
+                      step.workflow, jurisdiction_id)
+            raise falcon.HTTPConflict('Conflict', msg)
+
+        jurisdiction_type = model_cache.get(JurisdictionType, j.jurisdiction_type_id).name
+        lineage = j.lineage()
+        control_group = lineage[0]
 
         if jurisdiction_type == 'control_group':
-            if j.configuration['platform'] == 'amazon_web_services':
-                platform = AWS(j)
-                assets = platform.provision_control_group()
-                monitor_cloudformation_stack.delay(j.id)
-            else:
-                msg = 'Platform {} not supported'.format(j.configuration['platform'])
-                raise falcon.HTTPBadRequest('Bad request', msg)
+            pass
         elif jurisdiction_type == 'tier':
-            control_group = j.parent
             if not control_group.active:
                 msg = 'Control group {} is inactive. Tier must be provisioned in active control group'.format(control_group.name)
                 raise falcon.HTTPBadRequest('Bad request', msg)
-            if control_group.configuration['platform'] == 'amazon_web_services':
-                platform = AWS(j)
-                assets = platform.provision_tier()
-                monitor_cloudformation_stack.delay(j.id)
-            else:
-                msg = 'Platform {} not supported'.format(j.configuration['platform'])
-                raise falcon.HTTPBadRequest('Bad request', msg)
         elif jurisdiction_type == 'cluster':
-            tier = j.parent
-            control_group = j.parent.parent
+            tier = lineage[-2]
             if not tier.active:
                 msg = 'Tier {} is inactive. Tier must be provisioned in active control group'.format(tier.name)
                 raise falcon.HTTPBadRequest('Bad request', msg)
-            if control_group.configuration['platform'] == 'amazon_web_services':
-                platform = AWS(j)
-                assets = platform.provision_cluster()
-            else:
-                msg = 'Platform {} not supported'.format(j.configuration['platform'])
-                raise falcon.HTTPBadRequest('Bad request', msg)
         else:
             msg = 'Jurisdiction type {} not supported'.format(jurisdiction_type)
-            raise falcon.HTTPBadRequests('Bad request', msg)
+            raise falcon.HTTPBadRequest('Bad request', msg)
+
+        if control_group.configuration['platform'] != 'amazon_web_services':
+            msg = 'Platform {} not supported'.format(control_group.configuration['platform'])
+            raise falcon.HTTPBadRequest('Bad request', msg)
 
-        j.assets = assets
+        operation = Operation(action='provision', jurisdiction_id=j.id)
+        session.add(operation)
+        session.flush()
 
-        data = j.__attributes__()
+        data = operation.__attributes__()
+
+    tasks.provision_jurisdiction.delay(data['id'])
+
+    if response is not None:
+        response.status = falcon.HTTP_202
 
     return {'data': data}
 
 
+@hug.get('/get_operation/', version=1)
+def get_operation(operation_id: hug.types.number, request=None, response=None):
+    """
+    An operation tracks a long running action on a jurisdiction, such as
+    provisioning, that is carried out by a worker.
+
+    This handler returns an operation so that its status can be polled. The
+    status is one of pending, running, complete or failed. The message of a
+    failed operation describes the error. Responses include an ETag header
+    and conditional requests are handled as with get_jurisdictions.
+    """
+    with db.transaction() as session:
+        versions = get_versions(Operation, operation_id, session)
+        if not_modified(request, response, etag(versions)):
+            return
+
+        op_attrs = get_object_attributes(Operation, operation_id, session)
+
+    return {'data': op_attrs[0]}
+
+
 @hug.put('/decommission_jurisdiction/', version=1)
 def decommission_jurisdiction(jurisdiction_id: hug.types.number):
     """
@@ -269,57 +1086,77 @@ def decommission_jurisdiction(jurisdiction_id: hug.types.number):
 
     This handler removes the jurisdiction's infrastructure but does not delete
     the jurisdiction from the system. A jurisdiction may be re-provisioned
-    after being decommissioned.
+    after being decommissioned. If the jurisdiction is already being
+    provisioned or decommissioned, 409 Conflict is returned.
     """
     with db.transaction() as session:
-        j = get_objects(Jurisdiction, jurisdiction_id, session)
+        lock_jurisdiction(session, jurisdiction_id)
+        j = get_objects(Jurisdiction, jurisdiction_id, session, lineage=True)
 
         if j.active == False:
             msg = 'Jurisdiction with id {} not active'.format(jurisdiction_id)
             raise falcon.HTTPBadRequest('Bad request', msg)
 
-        jurisdiction_type = j.jurisdiction_type.name
+        check_operations(session, j.id)
+
+        jurisdiction_type = model_cache.get(JurisdictionType, j.jurisdiction_type_id).name
 
         if jurisdiction_type == 'control_group':
-            for child in j.children:
-                if child.active == True:
-                    msg = 'Child jurisdiction with id {} is still active'.format(child.id)
-                    raise falcon.HTTPBadRequest('Bad request', msg)
+            active_child = session.query(Jurisdiction.id)\
+                                  .filter_by(parent_id=j.id, active=True).first()
+            if active_child:
+                msg = 'Child jurisdiction with id {} is still active'.format(active_child.id)
+                raise falcon.HTTPBadRequest('Bad request', msg)
 
             if j.configuration['platform'] == 'amazon_web_services':
-                platform = AWS(j)
+                platform = AWS(j.snapshot())
                 assets = platform.decommission_jurisdiction()
             else:
                 msg = 'Platform {} not supported'.format(j.platform)
                 raise falcon.HTTPBadRequest('Bad request', msg)
         elif jurisdiction_type == 'tier':
-            for child in j.children:
-                if child.active == True:
-                    msg = 'Child jurisdiction with id {} is still active'.format(child.id)
-                    raise falcon.HTTPBadRequest('Bad request', msg)
-            control_group = j.parent
+            active_child = session.query(Jurisdiction.id)\
+                                  .filter_by(parent_id=j.id, active=True).first()
+            if active_child:
+                msg = 'Child jurisdiction with id {} is still active'.format(active_child.id)
+                raise falcon.HTTPBadRequest('Bad request', msg)
+            control_group = j.lineage()[0]
             if control_group.configuration['platform'] == 'amazon_web_services':
-                platform = AWS(j)
+                platform = AWS(j.snapshot())
                 assets = platform.decommission_jurisdiction()
             else:
                 msg = 'Platform {} not supported'.format(j.platform)
                 raise falcon.HTTPBadRequest('Bad request', msg)
         elif jurisdiction_type == 'cluster':
-            control_group = j.parent.parent
+            control_group = j.lineage()[0]
             if control_group.configuration['platform'] == 'amazon_web_services':
-                platform = AWS(j)
+                platform = AWS(j.snapshot())
                 assets = platform.decommission_jurisdiction()
             else:
                 msg = 'Platform {} not supported'.format(j.platform)
                 raise falcon.HTTPBadRequest('Bad request', msg)
         else:
             msg = 'Jurisdiction type {} not supported'.format(jurisdiction_type)
-            raise falcon.HTTPBadRequests('Bad request', msg)
+            raise falcon.HTTPBadRequest('Bad request', msg)
 
-        j.active = False
-        j.assets = assets
+        # the infrastructure is gone, so the jurisdiction is updated with
+        # statements that cannot conflict with a worker's concurrent update
+        # rather than by flushing the versioned object loaded above
+        jurisdiction_table = Jurisdiction.__table__
+        update = jurisdiction_table.update()\
+                                   .where(jurisdiction_table.c.id == j.id)\
+                                   .values(active=False,
+                                           assets=assets,
+                                           version=jurisdiction_table.c.version + 1)\
+                                   .returning(*jurisdiction_table.c)
+        row = session.execute(update).first()
+        session.query(Stack).filter_by(jurisdiction_id=j.id)\
+               .delete(synchronize_session=False)
+        # stops any workflow still provisioning the jurisdiction
+        session.query(WorkflowStep).filter_by(jurisdiction_id=j.id)\
+               .delete(synchronize_session=False)
 
-        data = j.__attributes__()
+        data = returned_attributes(Jurisdiction, row, session)
 
     return {'data': data}
 
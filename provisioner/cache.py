@@ -0,0 +1,85 @@
+import hashlib
+import json
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+
+class ModelCache(object):
+    """
+    A per-process read-through cache for small tables that rarely change,
+    such as jurisdiction types and configuration templates.
+
+    Each table is loaded in full the first time it is used and is reloaded
+    once its time to live expires or after a transaction in this process
+    that writes to it is committed. Cached objects are detached from any
+    session so only their column attributes may be used.
+    """
+    def __init__(self, database, models, ttl=300):
+        self.database = database
+        self.models = tuple(models)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tables = {}
+
+        for model in self.models:
+            for identifier in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(model, identifier, self._written)
+        event.listen(self.database.Session, 'after_commit', self._committed)
+
+    def _written(self, mapper, connection, target):
+        session = object_session(target)
+        session.info.setdefault('invalidated_models', set()).add(mapper.class_)
+
+    def _committed(self, session):
+        for model in session.info.pop('invalidated_models', ()):
+            self.invalidate(model)
+
+    def _load(self, model):
+        with self.database.transaction() as session:
+            objects = session.query(model).order_by(model.id).all()
+            session.expunge_all()
+
+        attributes = json.dumps([o.__attributes__() for o in objects],
+                                sort_keys=True, default=str)
+
+        return {
+            'expires': time.time() + self.ttl,
+            'objects': objects,
+            'by_id': {o.id: o for o in objects},
+            'version': hashlib.sha1(attributes.encode('utf-8')).hexdigest()
+        }
+
+    def _table(self, model):
+        with self._lock:
+            table = self._tables.get(model)
+        if table and table['expires'] > time.time():
+            return table
+
+        table = self._load(model)
+        with self._lock:
+            self._tables[model] = table
+
+        return table
+
+    def all(self, model):
+        """Return all objects of a model ordered by id"""
+        return self._table(model)['objects']
+
+    def get(self, model, obj_id):
+        """Return the object of a model with an id or None if there is none"""
+        return self._table(model)['by_id'].get(obj_id)
+
+    def version(self, model):
+        """Return a digest of the cached objects of a model that changes with them"""
+        return self._table(model)['version']
+
+    def invalidate(self, model=None):
+        """Discard the cached objects of a model or, by default, all models"""
+        with self._lock:
+            if model:
+                self._tables.pop(model, None)
+            else:
+                self._tables.clear()
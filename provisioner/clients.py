@@ -0,0 +1,53 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+
+class ClientRegistry(object):
+    """
+    A per-process registry of boto3 clients so that credentials and
+    endpoints are resolved once per service, region and account and their
+    connections are kept alive and reused across calls.
+
+    Clients are created on first use with one boto3 session per account,
+    an account being the name of a profile or None for the default
+    credentials. Clients may be shared by threads but are never used across
+    a fork: a child process discards those it inherited along with their
+    connections and creates its own.
+    """
+    def __init__(self, max_pool_connections=10):
+        self.config = Config(max_pool_connections=max_pool_connections)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._sessions = {}
+        self._clients = {}
+
+    def get(self, service, region, account=None):
+        """Return the client of a service in a region for an account"""
+        key = (service, region, account)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+            client = self._clients.get(key)
+            if not client:
+                # sessions are not thread safe, so clients are only created
+                # while the lock is held
+                session = self._sessions.get(account)
+                if not session:
+                    session = self._sessions[account] = boto3.Session(profile_name=account)
+                client = self._clients[key] = session.client(service,
+                                                             region_name=region,
+                                                             config=self.config)
+
+        return client
+
+    def clear(self):
+        """Discard all clients so that they are created again on next use"""
+        with self._lock:
+            self._reset()
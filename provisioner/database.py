@@ -1,37 +1,410 @@
 #!/usr/bin/env python
+import json
+import logging
 import os
+import queue
+import select
+import threading
+import time
 from contextlib import contextmanager
+from functools import wraps
 from subprocess import call
 
 import psycopg2
 import sqlalchemy
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import event, exc
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import NullPool
 
 from provisioner import defaults
 from provisioner import models
 
 
+logger = logging.getLogger(__name__)
+
+JURISDICTION_CHANNEL = 'jurisdiction_changes'
+
+# advisory lock held while migrating the schema
+MIGRATION_LOCK_KEY = 7366
+
+# seconds the listener waits for notifications before checking that it is
+# still the process's listener
+LISTENER_CHECK_INTERVAL = 5
+
+# how often the replication lag of a read replica is checked, in seconds
+REPLICA_CHECK_INTERVAL = 5
+
+# seconds since the replica last replayed a transaction from the primary,
+# or 0 if the database is not a replica; an idle primary overstates it,
+# which only sends reads to the primary
+REPLICA_LAG_QUERY = """
+    SELECT CASE WHEN pg_is_in_recovery()
+                THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                ELSE 0
+           END
+"""
+
+# namespace of the advisory locks held while changing a jurisdiction's
+# infrastructure; each is keyed by the jurisdiction's id within it
+JURISDICTION_LOCK_NAMESPACE = 7367
+
+# namespace of the advisory locks held while swept stack statuses of a region
+# are written
+REGION_LOCK_NAMESPACE = 7368
+
+# notifies listeners of the id and activity of every jurisdiction that is
+# inserted or updated when the transaction commits; changes to its stacks
+# are notified by STACK_NOTIFY_DDL
+JURISDICTION_NOTIFY_DDL = """
+    CREATE OR REPLACE FUNCTION notify_jurisdiction_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{0}', json_build_object(
+            'id', NEW.id,
+            'active', NEW.active
+        )::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS jurisdiction_change ON jurisdiction;
+    CREATE TRIGGER jurisdiction_change
+        AFTER INSERT OR UPDATE ON jurisdiction
+        FOR EACH ROW EXECUTE PROCEDURE notify_jurisdiction_change();
+""".format(JURISDICTION_CHANNEL)
+
+# notifies listeners of the jurisdiction id, key and status of every stack
+# that is inserted or updated on the jurisdiction channel
+STACK_NOTIFY_DDL = """
+    CREATE OR REPLACE FUNCTION notify_stack_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{0}', json_build_object(
+            'id', NEW.jurisdiction_id,
+            'key', NEW.key,
+            'status', NEW.status
+        )::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS stack_change ON stack;
+    CREATE TRIGGER stack_change
+        AFTER INSERT OR UPDATE ON stack
+        FOR EACH ROW EXECUTE PROCEDURE notify_stack_change();
+""".format(JURISDICTION_CHANNEL)
+
+
+# handed to waiters when the listener's connection is lost, as
+# notifications may have been missed
+MISSED = object()
+
+
+class Listener(object):
+    """
+    The process's subscription to Postgres notifications. One dedicated
+    connection, opened on first use, listens on every channel that has
+    waiters and a thread hands each notification to every waiter of its
+    channel, so waiting requests hold no connection of their own. A forked
+    process starts a listener of its own. If the connection is lost, every
+    waiter is told that notifications may have been missed and the next
+    subscription opens a new connection.
+    """
+    def __init__(self, connect):
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._connection = None
+        self._channels = set()
+        self._waiters = {}
+
+    def subscribe(self, channel):
+        """
+        Start waiting for the notifications on a channel. Returns a queue
+        that each notification's payload is put on once the channel is
+        listened to.
+        """
+        waiter = queue.Queue()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+            self._waiters.setdefault(channel, set()).add(waiter)
+            try:
+                if self._connection is None:
+                    connection = self.connect()
+                    connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                    self._connection = connection
+                    thread = threading.Thread(target=self._run, args=(connection,))
+                    thread.daemon = True
+                    thread.start()
+                for waited_on in set(self._waiters) - self._channels:
+                    cursor = self._connection.cursor()
+                    cursor.execute('LISTEN {}'.format(waited_on))
+                    cursor.close()
+                    self._channels.add(waited_on)
+                # notifications received while listening are not seen by
+                # the thread, which waits for the connection to be readable
+                self._dispatch()
+            except:
+                self._waiters[channel].discard(waiter)
+                raise
+
+        return waiter
+
+    def unsubscribe(self, channel, waiter):
+        """Stop waiting for the notifications on a channel"""
+        with self._lock:
+            self._waiters.get(channel, set()).discard(waiter)
+
+    def _dispatch(self):
+        while self._connection.notifies:
+            notification = self._connection.notifies.pop(0)
+            # a malformed payload is not a lost connection, so only it is
+            # dropped and the notifications after it are still handed out
+            try:
+                payload = json.loads(notification.payload)
+            except ValueError:
+                logger.warning('Notification on channel %s is not JSON: %r',
+                               notification.channel, notification.payload)
+                continue
+            for waiter in self._waiters.get(notification.channel, ()):
+                waiter.put(payload)
+
+    def _run(self, connection):
+        while True:
+            try:
+                select.select([connection], [], [], LISTENER_CHECK_INTERVAL)
+                with self._lock:
+                    if self._connection is not connection:
+                        return
+                    connection.poll()
+                    self._dispatch()
+            except (psycopg2.Error, select.error, ValueError):
+                with self._lock:
+                    if self._connection is connection:
+                        self._connection = None
+                        self._channels = set()
+                        for waiters in self._waiters.values():
+                            for waiter in waiters:
+                                waiter.put(MISSED)
+                try:
+                    connection.close()
+                except psycopg2.Error:
+                    pass
+                return
+
+
+class ChangeFeed(object):
+    """A subscription to the notifications sent on a Postgres channel"""
+    def __init__(self, listener, channel):
+        self.listener = listener
+        self.channel = channel
+        self.waiter = listener.subscribe(channel)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for notifications. Returns the payloads of
+        the notifications received, an empty list if there were none or None
+        if some may have been missed.
+        """
+        try:
+            payloads = [self.waiter.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                payloads.append(self.waiter.get_nowait())
+            except queue.Empty:
+                break
+
+        if any(p is MISSED for p in payloads):
+            return None
+        return payloads
+
+    def close(self):
+        self.listener.unsubscribe(self.channel, self.waiter)
+
+
+def apply_migration_step(connection, step):
+    """
+    Apply one step of a migration: call it with the connection or execute
+    its SQL. The SQL is executed without parameters so that the driver does
+    not read a % in it, as in a RAISE format string, as a placeholder.
+    """
+    if callable(step):
+        step(connection)
+    else:
+        connection.execution_options(no_parameters=True).execute(step)
+
+
 class Database(object):
-    def __init__(self, host, name, user, pwd):
+    """
+    The provisioner's database. Connections are pooled per process with the
+    given pool settings unless an external pooler such as pgbouncer is used,
+    in which case a connection is opened for each transaction. Pooled
+    connections inherited by a forked process are never reused by it, and
+    with pool_pre_ping connections are tested before use so that stale ones
+    are replaced.
+
+    Given the URL of a read replica, read only transactions are sent to the
+    replica while it lags the primary by no more than max_replica_lag
+    seconds and to the primary otherwise.
+
+    Notifications are received on one connection per process, made to
+    listen_url if given. An external pooler in transaction mode cannot
+    deliver notifications, so with one listen_url must reach the database
+    directly or through a pooler in session mode.
+    """
+    def __init__(self, host, name, user, pwd, pool_size=5, max_overflow=10,
+                 pool_recycle=-1, pool_pre_ping=False, external_pooler=False,
+                 replica_url=None, max_replica_lag=10, listen_url=None):
         self.name = name
-        self.engine = sqlalchemy.create_engine(
-                        'postgresql://{0}:{1}@{2}/{3}'.format(user, pwd, host, name))
+        self.pool_pre_ping = pool_pre_ping
+        self.max_replica_lag = max_replica_lag
+
+        url = 'postgresql://{0}:{1}@{2}/{3}'.format(user, pwd, host, name)
+        pool_settings = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_recycle': pool_recycle
+        }
+        self.engine = self._create_engine(url, external_pooler, pool_settings)
+        if replica_url:
+            self.replica_engine = self._create_engine(replica_url, external_pooler,
+                                                      pool_settings)
+        else:
+            self.replica_engine = None
+        self._replica_checked_on = 0
+        self._replica_current = False
+
         self.Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
 
+        listen_url = listen_url or url
+        self.listener = Listener(lambda: psycopg2.connect(listen_url))
+
+    def _create_engine(self, url, external_pooler, pool_settings):
+        if external_pooler:
+            engine = sqlalchemy.create_engine(url, poolclass=NullPool)
+        else:
+            engine = sqlalchemy.create_engine(url, **pool_settings)
+        event.listen(engine, 'connect', self._connected)
+        event.listen(engine, 'checkout', self._checked_out)
+
+        return engine
+
+    def _connected(self, dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    def _checked_out(self, dbapi_connection, connection_record, connection_proxy):
+        # a connection created before a fork belongs to the parent process;
+        # discard it without closing the parent's socket
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                    'Connection belongs to pid {0}, not pid {1}'.format(
+                        connection_record.info['pid'], os.getpid()))
+
+        if self.pool_pre_ping:
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                dbapi_connection.rollback()
+            except psycopg2.Error:
+                raise exc.DisconnectionError('Connection failed pre-ping')
+
+    def dispose(self):
+        """
+        Discard all pooled connections. Call after forking so that a child
+        process opens its own connections.
+        """
+        self.engine.dispose()
+        if self.replica_engine is not None:
+            self.replica_engine.dispose()
+
+    def replica_current(self):
+        """
+        Return whether read only transactions may be sent to the replica. Its
+        lag is checked at most every REPLICA_CHECK_INTERVAL seconds and an
+        unreachable replica is treated as lagging.
+        """
+        if self.replica_engine is None:
+            return False
+
+        now = time.time()
+        if now - self._replica_checked_on >= REPLICA_CHECK_INTERVAL:
+            try:
+                lag = self.replica_engine.execute(REPLICA_LAG_QUERY).scalar()
+                self._replica_current = lag <= self.max_replica_lag
+            except exc.DBAPIError:
+                self._replica_current = False
+            self._replica_checked_on = now
+
+        return self._replica_current
+
     def create_db(self):
         call(['createdb', self.name])
 
     def create_schema(self):
         self.engine.execute('CREATE EXTENSION IF NOT EXISTS hstore')
         models.Base.metadata.create_all(self.engine)
+        self.migrate()
 
     def create(self):
         self.create_db()
         self.create_schema()
 
+    def migrate(self):
+        """
+        Apply the schema migrations that have not been applied yet in order of
+        version, each in its own transaction. An advisory lock ensures only one
+        process migrates the database at a time.
+        """
+        from provisioner.migrations import MIGRATIONS
+
+        with self.engine.connect() as connection:
+            connection.execute(sqlalchemy.text('SELECT pg_advisory_lock(:key)'),
+                               key=MIGRATION_LOCK_KEY)
+            try:
+                models.SchemaMigration.__table__.create(connection, checkfirst=True)
+                applied = set(row.version for row in connection.execute(
+                                sqlalchemy.select([models.SchemaMigration.version])))
+                for version, description, steps in sorted(MIGRATIONS, key=lambda m: m[0]):
+                    if version in applied:
+                        continue
+                    with connection.begin():
+                        for step in steps:
+                            apply_migration_step(connection, step)
+                        connection.execute(models.SchemaMigration.__table__.insert(),
+                                           version=version,
+                                           description=description)
+            finally:
+                connection.execute(sqlalchemy.text('SELECT pg_advisory_unlock(:key)'),
+                                   key=MIGRATION_LOCK_KEY)
+
     @contextmanager
-    def transaction(self):
-        session = self.Session()
+    def transaction(self, readonly=False):
+        """
+        Provide a session whose transaction is committed at the end of the
+        context or rolled back if an error is raised. Updates to versioned
+        objects such as jurisdictions raise StaleDataError if the object was
+        updated concurrently; see retried for retrying them.
+
+        A readonly transaction cannot write and is sent to the read replica,
+        if there is one and it is current, so it may not see the latest
+        writes.
+        """
+        if readonly and self.replica_current():
+            session = self.Session(bind=self.replica_engine)
+        else:
+            session = self.Session()
         try:
+            if readonly:
+                session.execute('SET TRANSACTION READ ONLY')
             yield session
             session.commit()
         except:
@@ -40,6 +413,73 @@ class Database(object):
         finally:
             session.close()
 
+    def retried(self, retries=3):
+        """
+        Decorate a function that takes a session as its first argument so that
+        it is called in a transaction that is retried up to retries times when
+        a versioned object it updates was updated concurrently. The function
+        is called again from the start with a new session, so it must reload
+        what it updates and must not have side effects outside the database.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                attempt = 0
+                while True:
+                    try:
+                        with self.transaction() as session:
+                            return func(session, *args, **kwargs)
+                    except StaleDataError:
+                        attempt += 1
+                        if attempt > retries:
+                            raise
+            return wrapper
+        return decorator
+
+    def try_lock_jurisdiction(self, session, jurisdiction_id):
+        """
+        Try to take the advisory lock of a jurisdiction for the rest of the
+        session's transaction without waiting. Returns True if it was taken
+        or False if another transaction, in any process, holds it. Locks of
+        different jurisdictions never wait on one another.
+        """
+        return session.execute(
+                   sqlalchemy.text('SELECT pg_try_advisory_xact_lock(:namespace, :key)'),
+                   {'namespace': JURISDICTION_LOCK_NAMESPACE, 'key': jurisdiction_id}
+               ).scalar()
+
+    def try_lock_region(self, session, region):
+        """
+        Try to take the advisory lock of a region for the rest of the
+        session's transaction without waiting. Returns True if it was taken
+        or False if another transaction holds it.
+        """
+        return session.execute(
+                   sqlalchemy.text('SELECT pg_try_advisory_xact_lock(:namespace, hashtext(:key))'),
+                   {'namespace': REGION_LOCK_NAMESPACE, 'key': region}
+               ).scalar()
+
+    @contextmanager
+    def listen(self, channel):
+        """
+        Subscribe to the notifications on a channel, e.g. JURISDICTION_CHANNEL
+        for jurisdiction inserts and updates, for the duration of the context.
+        Yields a ChangeFeed to wait on.
+        """
+        feed = ChangeFeed(self.listener, channel)
+        try:
+            yield feed
+        finally:
+            feed.close()
+
+    def notify(self, session, channel, payload):
+        """
+        Send a JSON payload to the listeners of a channel when the session's
+        transaction commits.
+        """
+        session.execute('SELECT pg_notify(:channel, :payload)',
+                        {'channel': channel, 'payload': json.dumps(payload)})
+
 
 if __name__ == '__main__':
     db_host = os.environ.get('DB_HOST')
@@ -61,7 +501,9 @@ if __name__ == '__main__':
             defaults.load_defaults(db)
             exit('Database exists, schema created')
         else:
-            exit('Database, schema already exist')
+            db = Database(db_host, db_name, db_user, db_pwd)
+            db.migrate()
+            exit('Database, schema already exist, migrations applied')
 
     except psycopg2.OperationalError as e:
         err_msg = 'database "{}" does not exist'.format(db_name)
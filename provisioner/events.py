@@ -0,0 +1,155 @@
+"""
+Cloudformation stack events delivered as they happen instead of polled.
+
+When STACK_EVENTS_TOPIC_ARN is set, stacks are created with an SNS topic as
+their notification ARN. The topic ARN may contain {region} as stacks can
+only notify topics in their own region. The topics are subscribed to an SQS
+queue, STACK_EVENTS_QUEUE_URL, that the consume_stack_events task drains.
+
+STACK_EVENTS_FILE may be set instead of the queue URL to read the events
+from a file of notifications, one per line, so that the consumer can be
+exercised without AWS. FileEventQueue.publish appends events to it.
+"""
+import datetime
+import json
+import os
+
+from provisioner import aws_clients
+
+
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+
+def utc_timestamp():
+    """Return the current time formatted as the timestamps of stack events"""
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def notification_arns(region):
+    """Return the notification ARNs for stacks created in a region"""
+    topic_arn = os.environ.get('STACK_EVENTS_TOPIC_ARN')
+    if not topic_arn:
+        return []
+    return [topic_arn.format(region=region)]
+
+
+def stack_event_message(stack_id, status, timestamp):
+    """
+    Return a notification of a change in a stack's status formatted as
+    cloudformation formats its notifications
+    """
+    fields = [
+        ('StackId', stack_id),
+        ('Timestamp', timestamp),
+        ('LogicalResourceId', stack_id.split('/')[1]),
+        ('PhysicalResourceId', stack_id),
+        ('ResourceStatus', status),
+        ('ResourceType', STACK_RESOURCE_TYPE)
+    ]
+    return ''.join("{}='{}'\n".format(key, value) for key, value in fields)
+
+
+def parse_stack_event(body):
+    """
+    Return the stack id, status and timestamp of a notification of a change
+    in a stack's status or None if it notifies a change in one of the stack's
+    resources. The notification may be wrapped in an SNS envelope.
+    """
+    try:
+        message = json.loads(body)['Message']
+    except (ValueError, TypeError, KeyError):
+        message = body
+
+    fields = {}
+    for line in message.splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            fields[key] = value.strip("'")
+
+    if fields.get('ResourceType') != STACK_RESOURCE_TYPE or \
+       fields.get('PhysicalResourceId') != fields.get('StackId'):
+        return None
+
+    return fields['StackId'], fields['ResourceStatus'], fields['Timestamp']
+
+
+class SQSEventQueue(object):
+    """The SQS queue that stack event topics are subscribed to"""
+    def __init__(self, url):
+        self.url = url
+        # queue urls are of the form https://sqs.<region>.amazonaws.com/...
+        self.client = aws_clients.get('sqs', url.split('.')[1])
+
+    def receive(self):
+        """Return up to 10 messages as pairs of receipt handle and body"""
+        response = self.client.receive_message(QueueUrl=self.url,
+                                               MaxNumberOfMessages=10,
+                                               WaitTimeSeconds=1)
+        return [(m['ReceiptHandle'], m['Body'])
+                for m in response.get('Messages', [])]
+
+    def delete(self, handles):
+        """Delete received messages once they have been handled"""
+        handles = list(handles)
+        for i in range(0, len(handles), 10):
+            self.client.delete_message_batch(
+                QueueUrl=self.url,
+                Entries=[{'Id': str(n), 'ReceiptHandle': h}
+                         for n, h in enumerate(handles[i:i + 10])])
+
+
+class FileEventQueue(object):
+    """
+    A local stand-in for the SQS queue. Messages are lines appended to a
+    file and the offset of the first message not yet deleted is kept in a
+    file alongside it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+
+    def _offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read() or 0)
+        except IOError:
+            return 0
+
+    def publish(self, stack_id, status, timestamp):
+        """Append an event to the file as cloudformation would notify it"""
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({
+                'Type': 'Notification',
+                'Message': stack_event_message(stack_id, status, timestamp)
+            }) + '\n')
+
+    def receive(self):
+        """Return up to 10 messages as pairs of end offset and body"""
+        messages = []
+        try:
+            with open(self.path) as f:
+                f.seek(self._offset())
+                while len(messages) < 10:
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        break
+                    messages.append((f.tell(), line.rstrip('\n')))
+        except IOError:
+            pass
+        return messages
+
+    def delete(self, handles):
+        """Advance the offset past received messages once they are handled"""
+        handles = list(handles)
+        if handles:
+            with open(self.offset_path, 'w') as f:
+                f.write(str(max(handles)))
+
+
+def event_queue():
+    """Return the configured stack event queue or None if there is none"""
+    if os.environ.get('STACK_EVENTS_QUEUE_URL'):
+        return SQSEventQueue(os.environ['STACK_EVENTS_QUEUE_URL'])
+    if os.environ.get('STACK_EVENTS_FILE'):
+        return FileEventQueue(os.environ['STACK_EVENTS_FILE'])
+    return None
@@ -0,0 +1,336 @@
+"""
+Versioned changes to the database schema.
+
+Each migration is a version number, a description and a list of steps. A
+step is either a SQL statement or a callable that is passed the connection.
+Migrations are applied in order of version by Database.migrate, each in its
+own transaction, and recorded in the schema_migration table so that each is
+applied once. A new database is created from the models and then migrated,
+so steps must succeed whether or not the models already created what they
+add, e.g. by using IF NOT EXISTS.
+
+Migrations must never be edited once released. Add a new one instead.
+"""
+from provisioner import models
+from provisioner.database import JURISDICTION_NOTIFY_DDL, STACK_NOTIFY_DDL
+
+
+MIGRATIONS = [
+    (
+        1,
+        'Add operations and jurisdiction update times',
+        [
+            lambda connection: models.Operation.__table__.create(connection,
+                                                                 checkfirst=True),
+            """
+                ALTER TABLE jurisdiction
+                ADD COLUMN IF NOT EXISTS updated_on TIMESTAMP WITH TIME ZONE
+            """,
+            """
+                UPDATE jurisdiction SET updated_on = created_on
+                WHERE updated_on IS NULL
+            """
+        ]
+    ),
+    (
+        2,
+        'Notify listeners of jurisdiction changes',
+        [
+            JURISDICTION_NOTIFY_DDL
+        ]
+    ),
+    (
+        3,
+        'Index jurisdiction hierarchy and JSONB lookups',
+        [
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_parent_id
+                ON jurisdiction (parent_id)
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_jurisdiction_type_id
+                ON jurisdiction (jurisdiction_type_id)
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_updated_on
+                ON jurisdiction (updated_on)
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_configuration
+                ON jurisdiction USING gin (configuration jsonb_path_ops)
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_assets
+                ON jurisdiction USING gin (assets jsonb_path_ops)
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_configuration_region
+                ON jurisdiction ((configuration ->> 'region'))
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_operation_jurisdiction_id
+                ON operation (jurisdiction_id)
+            """
+        ]
+    ),
+    (
+        4,
+        'Materialize the ancestry path of jurisdictions',
+        [
+            """
+                ALTER TABLE jurisdiction
+                ADD COLUMN IF NOT EXISTS path INTEGER[]
+            """,
+            """
+                CREATE OR REPLACE FUNCTION set_jurisdiction_path() RETURNS trigger AS $$
+                DECLARE
+                    parent_path INTEGER[];
+                BEGIN
+                    IF NEW.parent_id IS NULL THEN
+                        NEW.path := ARRAY[NEW.id];
+                    ELSE
+                        SELECT path INTO parent_path FROM jurisdiction
+                        WHERE id = NEW.parent_id;
+                        IF NEW.id = ANY(parent_path) THEN
+                            RAISE EXCEPTION 'Jurisdiction % cannot be nested within itself', NEW.id;
+                        END IF;
+                        NEW.path := parent_path || NEW.id;
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION move_jurisdiction_descendants() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE jurisdiction
+                    SET path = NEW.path || path[array_length(OLD.path, 1) + 1:array_length(path, 1)]
+                    WHERE path @> ARRAY[NEW.id] AND id <> NEW.id;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                DROP TRIGGER IF EXISTS jurisdiction_path ON jurisdiction;
+                CREATE TRIGGER jurisdiction_path
+                    BEFORE INSERT OR UPDATE OF parent_id ON jurisdiction
+                    FOR EACH ROW EXECUTE PROCEDURE set_jurisdiction_path();
+
+                DROP TRIGGER IF EXISTS jurisdiction_descendants_path ON jurisdiction;
+                CREATE TRIGGER jurisdiction_descendants_path
+                    AFTER UPDATE OF parent_id ON jurisdiction
+                    FOR EACH ROW
+                    WHEN (OLD.parent_id IS DISTINCT FROM NEW.parent_id)
+                    EXECUTE PROCEDURE move_jurisdiction_descendants();
+            """,
+            """
+                WITH RECURSIVE tree AS (
+                    SELECT id, ARRAY[id] AS path
+                    FROM jurisdiction WHERE parent_id IS NULL
+                  UNION ALL
+                    SELECT child.id, tree.path || child.id
+                    FROM jurisdiction child JOIN tree ON child.parent_id = tree.id
+                )
+                UPDATE jurisdiction SET path = tree.path
+                FROM tree WHERE jurisdiction.id = tree.id
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_path
+                ON jurisdiction USING gin (path)
+            """
+        ]
+    ),
+    (
+        5,
+        'Move cloudformation stacks out of jurisdiction assets',
+        [
+            lambda connection: models.Stack.__table__.create(connection,
+                                                             checkfirst=True),
+            """
+                INSERT INTO stack (jurisdiction_id, key, stack_id, region,
+                                   status, updated_at)
+                SELECT j.id, 'main', j.assets #>> '{cloudformation_stack,stack_id}',
+                       root.configuration ->> 'region',
+                       j.assets #>> '{cloudformation_stack,status}', j.updated_on
+                FROM jurisdiction j JOIN jurisdiction root ON root.id = j.path[1]
+                WHERE j.assets -> 'cloudformation_stack' ? 'stack_id'
+                ON CONFLICT DO NOTHING
+            """,
+            """
+                INSERT INTO stack (jurisdiction_id, key, stack_id, region,
+                                   status, updated_at)
+                SELECT j.id, s.key, s.value ->> 'stack_id',
+                       root.configuration ->> 'region',
+                       s.value ->> 'status', j.updated_on
+                FROM jurisdiction j
+                JOIN jurisdiction root ON root.id = j.path[1]
+                CROSS JOIN LATERAL jsonb_each(j.assets -> 'cloudformation_stack') s
+                WHERE j.assets ? 'cloudformation_stack'
+                AND NOT j.assets -> 'cloudformation_stack' ? 'stack_id'
+                ON CONFLICT DO NOTHING
+            """,
+            """
+                UPDATE jurisdiction SET assets = assets - 'cloudformation_stack'
+                WHERE assets ? 'cloudformation_stack'
+            """,
+            STACK_NOTIFY_DDL
+        ]
+    ),
+    (
+        6,
+        'Version jurisdictions for optimistic concurrency',
+        [
+            """
+                ALTER TABLE jurisdiction
+                ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1
+            """
+        ]
+    ),
+    (
+        7,
+        'Store the effective configuration of jurisdictions',
+        [
+            """
+                ALTER TABLE jurisdiction
+                ADD COLUMN IF NOT EXISTS effective_configuration JSONB
+            """,
+            """
+                CREATE OR REPLACE FUNCTION resolve_jurisdiction_configuration(
+                    jurisdiction_path INTEGER[]) RETURNS jsonb AS $$
+                    SELECT COALESCE(jsonb_object_agg(c.key, c.value ORDER BY p.depth),
+                                    '{}'::jsonb)
+                    FROM unnest(jurisdiction_path) WITH ORDINALITY AS p(id, depth)
+                    JOIN jurisdiction a ON a.id = p.id
+                    CROSS JOIN LATERAL jsonb_each(a.configuration) c
+                $$ LANGUAGE sql STABLE;
+
+                CREATE OR REPLACE FUNCTION set_jurisdiction_effective_configuration()
+                RETURNS trigger AS $$
+                BEGIN
+                    NEW.effective_configuration := COALESCE(
+                        (SELECT effective_configuration FROM jurisdiction
+                         WHERE id = NEW.parent_id),
+                        '{}'::jsonb) || NEW.configuration;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE FUNCTION propagate_jurisdiction_configuration()
+                RETURNS trigger AS $$
+                BEGIN
+                    UPDATE jurisdiction
+                    SET effective_configuration = resolve_jurisdiction_configuration(path),
+                        updated_on = now(),
+                        version = version + 1
+                    WHERE path @> ARRAY[NEW.id] AND id <> NEW.id;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                DROP TRIGGER IF EXISTS jurisdiction_effective_configuration ON jurisdiction;
+                CREATE TRIGGER jurisdiction_effective_configuration
+                    BEFORE INSERT OR UPDATE OF configuration, parent_id ON jurisdiction
+                    FOR EACH ROW EXECUTE PROCEDURE set_jurisdiction_effective_configuration();
+
+                -- fires after jurisdiction_descendants_path, as triggers fire in
+                -- order of name, so that descendants' paths are already moved
+                DROP TRIGGER IF EXISTS jurisdiction_propagate_configuration ON jurisdiction;
+                CREATE TRIGGER jurisdiction_propagate_configuration
+                    AFTER UPDATE OF configuration, parent_id ON jurisdiction
+                    FOR EACH ROW
+                    WHEN (OLD.configuration IS DISTINCT FROM NEW.configuration
+                          OR OLD.parent_id IS DISTINCT FROM NEW.parent_id)
+                    EXECUTE PROCEDURE propagate_jurisdiction_configuration();
+            """,
+            """
+                UPDATE jurisdiction
+                SET effective_configuration = resolve_jurisdiction_configuration(path)
+            """
+        ]
+    ),
+    (
+        8,
+        'Index stacks by cloudformation stack id',
+        [
+            """
+                CREATE INDEX IF NOT EXISTS ix_stack_stack_id
+                ON stack (stack_id)
+            """
+        ]
+    ),
+    (
+        9,
+        'Add workflow steps',
+        [
+            lambda connection: models.WorkflowStep.__table__.create(connection,
+                                                                    checkfirst=True)
+        ]
+    ),
+    (
+        10,
+        'Record the transaction that last changed each jurisdiction and stack',
+        [
+            """
+                ALTER TABLE jurisdiction ADD COLUMN IF NOT EXISTS txid BIGINT
+            """,
+            """
+                ALTER TABLE stack ADD COLUMN IF NOT EXISTS txid BIGINT
+            """,
+            """
+                CREATE OR REPLACE FUNCTION set_txid() RETURNS trigger AS $$
+                BEGIN
+                    NEW.txid := txid_current();
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                DROP TRIGGER IF EXISTS jurisdiction_txid ON jurisdiction;
+                CREATE TRIGGER jurisdiction_txid
+                    BEFORE INSERT OR UPDATE ON jurisdiction
+                    FOR EACH ROW EXECUTE PROCEDURE set_txid();
+
+                DROP TRIGGER IF EXISTS stack_txid ON stack;
+                CREATE TRIGGER stack_txid
+                    BEFORE INSERT OR UPDATE ON stack
+                    FOR EACH ROW EXECUTE PROCEDURE set_txid();
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_jurisdiction_txid
+                ON jurisdiction (txid)
+            """,
+            """
+                CREATE INDEX IF NOT EXISTS ix_stack_txid
+                ON stack (txid)
+            """
+        ]
+    ),
+    (
+        11,
+        'Stop notifying jurisdiction stacks from assets and drop the update time index',
+        [
+            # stacks were moved out of assets by migration 5
+            JURISDICTION_NOTIFY_DDL,
+            # changes are found by transaction id since migration 10
+            """
+                DROP INDEX IF EXISTS ix_jurisdiction_updated_on
+            """
+        ]
+    ),
+    (
+        12,
+        'Record when the status of each stack was seen',
+        [
+            """
+                ALTER TABLE stack ADD COLUMN IF NOT EXISTS status_at TIMESTAMPTZ
+            """
+        ]
+    ),
+    (
+        13,
+        'Link workflow steps to the operation that started them',
+        [
+            """
+                ALTER TABLE workflow_step
+                ADD COLUMN IF NOT EXISTS operation_id INTEGER REFERENCES operation (id)
+            """
+        ]
+    )
+]
@@ -1,14 +1,26 @@
+import copy
 import datetime
+import os
+from collections import namedtuple
+from types import MappingProxyType
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Boolean
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, DateTime, Text, Boolean
+from sqlalchemy import func
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm import aliased, joinedload, raiseload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import UniqueConstraint, FetchedValue
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import JSONB, HSTORE
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, HSTORE
 
 
 Base = declarative_base()
 
+# with RAISE_ON_LAZY_LOAD=true the relationships of jurisdictions loaded with
+# their lineage raise rather than lazily load what was not loaded up front,
+# so that tests fail on queries hidden in attribute access
+RAISE_ON_LAZY_LOAD = os.environ.get('RAISE_ON_LAZY_LOAD') == 'true'
+
 
 class JurisdictionType(Base):
     """
@@ -90,6 +102,8 @@ class Jurisdiction(Base):
     id                    = Column(Integer, primary_key=True, autoincrement=True)
     name                  = Column(Text, nullable=False, unique=True)
     created_on            = Column(DateTime(timezone=True), default=datetime.datetime.utcnow())
+    updated_on            = Column(DateTime(timezone=True), default=datetime.datetime.utcnow,
+                                   onupdate=datetime.datetime.utcnow)
     active                = Column(Boolean, default=False)
     configuration         = Column(JSONB, nullable=False)
     assets                = Column(JSONB)
@@ -97,6 +111,22 @@ class Jurisdiction(Base):
     jurisdiction_type_id  = Column(Integer, ForeignKey('jurisdiction_type.id'),
                                    nullable=False)
     parent_id             = Column(Integer, ForeignKey('jurisdiction.id'), default=None)
+    # ids from the root of the hierarchy down to this jurisdiction, maintained
+    # by the database whenever a jurisdiction is inserted or its parent changes
+    path                  = Column(ARRAY(Integer), server_default=FetchedValue(),
+                                   server_onupdate=FetchedValue())
+    # the configuration of the root of the hierarchy overridden by that of
+    # each jurisdiction down to this one, maintained by the database whenever
+    # a jurisdiction's configuration or parent changes
+    effective_configuration = Column(JSONB, server_default=FetchedValue(),
+                                     server_onupdate=FetchedValue())
+    # incremented by every update so that concurrent updates are detected
+    version               = Column(Integer, nullable=False, server_default='1')
+    # the id of the transaction that last inserted or updated the
+    # jurisdiction, set by the database so that changes can be followed in
+    # order of commit rather than of update time
+    txid                  = Column(BigInteger, server_default=FetchedValue(),
+                                   server_onupdate=FetchedValue())
     #userdata_template_id  = Column(Integer, ForeignKey('userdata_template.id'), default=None)
 
     jurisdiction_type = relationship('JurisdictionType', backref='jurisdictions',
@@ -106,16 +136,318 @@ class Jurisdiction(Base):
     #userdata_template = relationship('UserdataTemplate', backref='jurisdictions',
     #                                 foreign_keys=userdata_template_id)
 
+    # updates compare and swap the version and fail with StaleDataError if
+    # the jurisdiction was updated since it was loaded
+    __mapper_args__ = {'version_id_col': version}
+
+    # maps the attribute names exposed by the API to column attributes
+    __attribute_columns__ = {
+        'id':                      'id',
+        'name':                    'name',
+        'created_on':              'created_on',
+        'active':                  'active',
+        'assets':                  'assets',
+        'configuration':           'configuration',
+        'effective_configuration': 'effective_configuration',
+        'metadata':                'jurisdiction_metadata',
+        'jurisdiction_type_id':    'jurisdiction_type_id',
+        'parent_id':               'parent_id'
+    }
+
+    def __attributes__(self, fields=None):
+        """
+        Return the jurisdiction's attributes.  If fields are given only those
+        attributes are returned so that deferred columns are never loaded.
+        """
+        attributes = {}
+        for attr, column in self.__attribute_columns__.items():
+            if fields is None or attr in fields:
+                attributes[attr] = getattr(self, column)
+
+        if 'assets' in attributes:
+            attributes['assets'] = stack_assets(attributes['assets'], self.stacks)
+
+        return attributes
+
+    _lineage = None
+
+    @classmethod
+    def load_with_lineage(cls, session, jurisdiction_id):
+        """
+        Load a jurisdiction together with its ancestors, and the types and
+        stacks of each, in one joined query on the materialized path. Each
+        one's lineage and parent are set from the results so that they need
+        not be loaded again. Returns None if the jurisdiction does not exist.
+        """
+        target = aliased(cls, name='target')
+        options = [joinedload(cls.jurisdiction_type), joinedload(cls.stacks)]
+        if RAISE_ON_LAZY_LOAD:
+            options.append(raiseload('*'))
+
+        lineage = session.query(cls)\
+                         .join(target, target.path.any(cls.id))\
+                         .filter(target.id == jurisdiction_id)\
+                         .options(*options)\
+                         .order_by(func.array_length(cls.path, 1))\
+                         .all()
+
+        for i, j in enumerate(lineage):
+            j._lineage = lineage[:i + 1]
+            set_committed_value(j, 'parent', lineage[i - 1] if i else None)
+
+        return lineage[-1] if lineage else None
+
+    def lineage(self):
+        """
+        Return the jurisdiction's ancestors from the root of the hierarchy
+        down, followed by the jurisdiction itself. They are loaded with
+        load_with_lineage unless they already have been.
+        """
+        if self._lineage is None:
+            Jurisdiction.load_with_lineage(object_session(self), self.id)
+
+        return self._lineage
+
+    def snapshot(self):
+        """Return a JurisdictionSnapshot of the jurisdiction as loaded"""
+        lineage = self.lineage()
+
+        return JurisdictionSnapshot(
+                   id=self.id,
+                   name=self.name,
+                   type=self.jurisdiction_type.name,
+                   region=lineage[0].configuration['region'],
+                   bucket=(lineage[0].assets or {}).get('s3_bucket'),
+                   configuration=self.effective_configuration,
+                   assets=self.assets or {},
+                   stacks={s.key: s.stack_id for s in self.stacks},
+                   lineage=[(j.id, j.name) for j in lineage])
+
+    def ancestors(self):
+        """Return the jurisdiction's ancestors from the root down"""
+        return self.lineage()[:-1]
+
+    def descendants(self):
+        """
+        Return the jurisdictions nested within this one, ordered by depth and
+        id, using a single indexed query on the materialized path
+        """
+        session = object_session(self)
+
+        return session.query(Jurisdiction)\
+                      .filter(Jurisdiction.path.contains([self.id]))\
+                      .filter(Jurisdiction.id != self.id)\
+                      .order_by(func.array_length(Jurisdiction.path, 1), Jurisdiction.id)\
+                      .all()
+
+
+class Stack(Base):
+    """
+    A Stack is a cloudformation stack provisioned for a Jurisdiction. Its
+    status is kept in a narrow row of its own so that monitoring a stack does
+    not rewrite the jurisdiction's assets. Control groups and tiers have one
+    stack with the main key while clusters have network and nodes stacks.
+    """
+    __tablename__ = 'stack'
+    __table_args__ = (UniqueConstraint('jurisdiction_id', 'key'),)
+
+    MAIN = 'main'
+
+    id              = Column(Integer, primary_key=True, autoincrement=True)
+    jurisdiction_id = Column(Integer, ForeignKey('jurisdiction.id'), nullable=False)
+    key             = Column(Text, nullable=False, default=MAIN)
+    stack_id        = Column(Text, nullable=False)
+    region          = Column(Text, nullable=False)
+    status          = Column(Text)
+    # when the status was seen, by its event or a sweep
+    status_at       = Column(DateTime(timezone=True))
+    updated_at      = Column(DateTime(timezone=True), default=datetime.datetime.utcnow,
+                             onupdate=datetime.datetime.utcnow)
+    # set by the database as for jurisdictions
+    txid            = Column(BigInteger, server_default=FetchedValue(),
+                             server_onupdate=FetchedValue())
+
+    jurisdiction = relationship('Jurisdiction',
+                                backref=backref('stacks', order_by=id,
+                                                cascade='all, delete-orphan'),
+                                foreign_keys=jurisdiction_id)
+
     def __attributes__(self):
         return {
-            'id':                   self.id,
-            'name':                 self.name,
-            'created_on':           self.created_on,
-            'active':               self.active,
-            'assets':               self.assets,
-            'configuration':        self.configuration,
-            'metadata':             self.jurisdiction_metadata,
-            'jurisdiction_type_id': self.jurisdiction_type_id,
-            'parent_id':            self.parent_id
+            'stack_id': self.stack_id,
+            'status':   self.status
         }
 
+
+def stack_assets(assets, stacks):
+    """
+    Return a jurisdiction's assets including its stacks under the
+    cloudformation_stack key, shaped as they were before stacks had a table
+    of their own: the main stack's attributes or those of each stack by key
+    """
+    if not stacks:
+        return assets
+
+    assets = dict(assets or {})
+    if len(stacks) == 1 and stacks[0].key == Stack.MAIN:
+        assets['cloudformation_stack'] = stacks[0].__attributes__()
+    else:
+        assets['cloudformation_stack'] = {s.key: s.__attributes__() for s in stacks}
+
+    return assets
+
+
+JurisdictionRef = namedtuple('JurisdictionRef', ('id', 'name'))
+
+
+class JurisdictionSnapshot(object):
+    """
+    A read only copy of what the platforms and tasks need to know about a
+    jurisdiction, taken when it was loaded with its lineage. Its
+    configuration is the jurisdiction's effective configuration, in which
+    its values override those of its ancestors, its region and bucket are
+    those of its control group and its stacks map keys to stack ids. The
+    lineage holds the id and name of each jurisdiction from the root down,
+    ending with this one.
+
+    Its attributes cannot be set and its mappings are read only. The values
+    in its mappings are deep copies, so nested dicts and lists can still be
+    changed but are never shared with the jurisdiction it was taken from or
+    with other snapshots.
+
+    A snapshot needs no session and is sent in task messages as the dict
+    returned by as_dict.
+    """
+    __slots__ = ('id', 'name', 'type', 'region', 'bucket', 'configuration',
+                 'assets', 'stacks', 'lineage')
+
+    def __init__(self, id, name, type, region, bucket, configuration, assets,
+                 stacks, lineage):
+        set_slot = super(JurisdictionSnapshot, self).__setattr__
+        set_slot('id', id)
+        set_slot('name', name)
+        set_slot('type', type)
+        set_slot('region', region)
+        set_slot('bucket', bucket)
+        set_slot('configuration', MappingProxyType(copy.deepcopy(dict(configuration))))
+        set_slot('assets', MappingProxyType(copy.deepcopy(dict(assets))))
+        set_slot('stacks', MappingProxyType(dict(stacks)))
+        set_slot('lineage', tuple(JurisdictionRef(*ref) for ref in lineage))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('JurisdictionSnapshot is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('JurisdictionSnapshot is immutable')
+
+    def __repr__(self):
+        return '<JurisdictionSnapshot {0} {1}>'.format(self.id, self.name)
+
+    def as_dict(self):
+        """Return the snapshot as a dict that can be serialized as JSON"""
+        attributes = {slot: getattr(self, slot) for slot in self.__slots__}
+        for mapping in ('configuration', 'assets', 'stacks'):
+            attributes[mapping] = copy.deepcopy(dict(attributes[mapping]))
+        attributes['lineage'] = [list(ref) for ref in self.lineage]
+
+        return attributes
+
+    @classmethod
+    def from_dict(cls, attributes):
+        """Return the snapshot a dict returned by as_dict was made from"""
+        return cls(**attributes)
+
+    def replace(self, **changes):
+        """Return a copy of the snapshot with some attributes changed"""
+        attributes = self.as_dict()
+        attributes.update(changes)
+
+        return JurisdictionSnapshot(**attributes)
+
+
+class Operation(Base):
+    """
+    An Operation tracks a long running action on a Jurisdiction, such as
+    provisioning, that is carried out by a worker after the API request that
+    started it has returned. Its status is one of pending, running, complete
+    or failed.
+    """
+    __tablename__ = 'operation'
+
+    id              = Column(Integer, primary_key=True, autoincrement=True)
+    action          = Column(Text, nullable=False)
+    status          = Column(Text, nullable=False, default='pending')
+    message         = Column(Text)
+    created_on      = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
+    updated_on      = Column(DateTime(timezone=True), default=datetime.datetime.utcnow,
+                             onupdate=datetime.datetime.utcnow)
+    jurisdiction_id = Column(Integer, ForeignKey('jurisdiction.id'), nullable=False)
+
+    jurisdiction = relationship('Jurisdiction', backref='operations',
+                                foreign_keys=jurisdiction_id)
+
+    def __attributes__(self):
+        return {
+            'id':              self.id,
+            'action':          self.action,
+            'status':          self.status,
+            'message':         self.message,
+            'created_on':      self.created_on,
+            'updated_on':      self.updated_on,
+            'jurisdiction_id': self.jurisdiction_id
+        }
+
+
+class WorkflowStep(Base):
+    """
+    A WorkflowStep is one step of a workflow, such as provisioning a
+    cluster, carried out for a Jurisdiction. The steps of a workflow are
+    created together from its definition in provisioner.workflows and each
+    is started once the steps it depends on are complete. A step that creates
+    a stack is complete once the stack is created. Its status is one of
+    waiting, running, complete or failed. The Operation that started the
+    workflow, if any, is failed if one of its steps fails.
+    """
+    __tablename__ = 'workflow_step'
+    __table_args__ = (UniqueConstraint('jurisdiction_id', 'workflow', 'name'),)
+
+    id              = Column(Integer, primary_key=True, autoincrement=True)
+    jurisdiction_id = Column(Integer, ForeignKey('jurisdiction.id'), nullable=False)
+    workflow        = Column(Text, nullable=False)
+    name            = Column(Text, nullable=False)
+    depends_on      = Column(ARRAY(Text), nullable=False, default=list)
+    action          = Column(Text, nullable=False)
+    stack_key       = Column(Text)
+    status          = Column(Text, nullable=False, default='waiting')
+    message         = Column(Text)
+    updated_on      = Column(DateTime(timezone=True), default=datetime.datetime.utcnow,
+                             onupdate=datetime.datetime.utcnow)
+    operation_id    = Column(Integer, ForeignKey('operation.id'))
+
+    def __attributes__(self):
+        return {
+            'id':              self.id,
+            'jurisdiction_id': self.jurisdiction_id,
+            'workflow':        self.workflow,
+            'name':            self.name,
+            'depends_on':      self.depends_on,
+            'action':          self.action,
+            'stack_key':       self.stack_key,
+            'status':          self.status,
+            'message':         self.message,
+            'updated_on':      self.updated_on,
+            'operation_id':    self.operation_id
+        }
+
+
+class SchemaMigration(Base):
+    """
+    A SchemaMigration records a versioned change to the database schema that
+    has been applied to the database. The migrations themselves are defined
+    in provisioner.migrations.
+    """
+    __tablename__ = 'schema_migration'
+
+    version     = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(Text, nullable=False)
+    applied_on  = Column(DateTime(timezone=True), default=datetime.datetime.utcnow)
@@ -4,7 +4,6 @@ import itertools
 import random
 import string
 
-import boto3
 import jinja2
 import requests
 from OpenSSL.crypto import PKey, X509, X509Req, X509Extension
@@ -13,23 +12,21 @@ from OpenSSL.crypto import TYPE_RSA, FILETYPE_PEM
 from troposphere import Template, Ref, Tags, Output, ImportValue, Export, AWSHelperFn
 from troposphere import ec2, s3, elasticloadbalancing, autoscaling, iam, cloudwatch, policies
 
-from provisioner import db
-from provisioner.tasks import monitor_cloudformation_stack, monitor_cluster_network
-from provisioner.tasks import monitor_cluster_nodes, monitor_decommission
-from provisioner.models import UserdataTemplate
+from provisioner import aws_clients, db
+from provisioner.events import notification_arns
+from provisioner.tasks import monitor_decommission, poll_later
+from provisioner.models import Stack, UserdataTemplate
 
 
 class AWS(object):
     def __init__(self, jurisdiction):
+        # a JurisdictionSnapshot, so no database access is needed
         self.jurisdiction = jurisdiction
 
-        j_type = self.jurisdiction.jurisdiction_type.name
-        if j_type == 'control_group':
-            self.region = self.jurisdiction.configuration['region']
-        elif j_type == 'tier':
-            self.region = self.jurisdiction.parent.configuration['region']
-        elif j_type == 'cluster':
-            self.region = self.jurisdiction.parent.parent.configuration['region']
+        lineage = self.jurisdiction.lineage
+        self.control_group = lineage[0]
+        self.tier = lineage[1] if len(lineage) > 1 else None
+        self.region = self.jurisdiction.region
 
         self.standard_egress = [
                 {
@@ -62,15 +59,9 @@ class AWS(object):
             ]
 
     def _save_to_s3(self, filepath, str_content):
-        s3_client = boto3.client('s3', region_name=self.region)
+        s3_client = aws_clients.get('s3', self.region)
 
-        j_type = self.jurisdiction.jurisdiction_type.name
-        if j_type == 'control_group':
-            bucket = self.jurisdiction.assets['s3_bucket']
-        elif j_type == 'tier':
-            bucket = self.jurisdiction.parent.assets['s3_bucket']
-        elif j_type == 'cluster':
-            bucket = self.jurisdiction.parent.parent.assets['s3_bucket']
+        bucket = self.jurisdiction.bucket
 
         s3_client.put_object(ACL='private',
                              Bucket=bucket,
@@ -81,7 +72,7 @@ class AWS(object):
         return base64.b64encode(gzip.compress(b_content))
 
     def _kms_encrypt(self, kms_key_arn, b_content):
-        kms_client = boto3.client('kms', region_name=self.region)
+        kms_client = aws_clients.get('kms', self.region)
 
         encrypted_content = kms_client.encrypt(
                                 KeyId=kms_key_arn,
@@ -309,9 +300,9 @@ class AWS(object):
                                                      )
                                                   ).decode('utf-8')
 
+        # the effective configuration, in which a cluster's values override
+        # those of its tier and control group
         template_vars.update(self.jurisdiction.configuration)
-        template_vars.update(self.jurisdiction.parent.configuration)
-        template_vars.update(self.jurisdiction.parent.parent.configuration)
 
         # generate userdata from template
         template_id = self.jurisdiction.configuration['userdata_template_ids'][role]
@@ -321,7 +312,7 @@ class AWS(object):
         userdata_content = userdata_template.render(template_vars)
 
         # save userdata file to s3 bucket
-        s3_client = boto3.client('s3', region_name=self.region)
+        s3_client = aws_clients.get('s3', self.region)
         userdata_filepath = '{0}/userdata/cloud-config-{1}-{2}'.format(
                                         self.jurisdiction.name, role, count)
         self._save_to_s3(userdata_filepath, userdata_content)
@@ -349,9 +340,10 @@ class AWS(object):
 
         stack_name = 'ControlGroup{}'.format(str(self.jurisdiction.id).zfill(2))
 
-        cf_client = boto3.client('cloudformation', region_name=self.region)
+        cf_client = aws_clients.get('cloudformation', self.region)
         cf_stack = cf_client.create_stack(StackName=stack_name,
-                                          TemplateBody=cg_template_content)
+                                          TemplateBody=cg_template_content,
+                                          NotificationARNs=notification_arns(self.region))
 
         return {
             'cloudformation_stack': {
@@ -380,7 +372,7 @@ class AWS(object):
             cidr_key = '{}_cluster_cidr'.format(vpc_label[1])
 
             tags=Tags(Name=tag_name,
-                      control_group=self.jurisdiction.parent.name,
+                      control_group=self.control_group.name,
                       tier=self.jurisdiction.name)
 
             vpc = tier_template.add_resource(ec2.VPC(
@@ -434,9 +426,10 @@ class AWS(object):
 
         stack_name = 'Tier{}'.format(str(self.jurisdiction.id).zfill(3))
 
-        cf_client = boto3.client('cloudformation', region_name=self.region)
+        cf_client = aws_clients.get('cloudformation', self.region)
         cf_stack = cf_client.create_stack(StackName=stack_name,
-                                             TemplateBody=tier_template_content)
+                                             TemplateBody=tier_template_content,
+                                             NotificationARNs=notification_arns(self.region))
 
         return {
             'cloudformation_stack': {
@@ -451,7 +444,7 @@ class AWS(object):
         net_template.add_version('2010-09-09')
         net_template.add_description('Network for Cluster: {}'.format(self.jurisdiction.name))
 
-        ec2_client = boto3.client('ec2', region_name=self.region)
+        ec2_client = aws_clients.get('ec2', self.region)
 
         # subnets
         azs = ec2_client.describe_availability_zones()
@@ -474,8 +467,8 @@ class AWS(object):
             tag_name = '{}_s{}'.format(self.jurisdiction.name,
                                        subnet_counter)
             tags=Tags(Name=tag_name,
-                      control_group=self.jurisdiction.parent.parent.name,
-                      tier=self.jurisdiction.parent.name,
+                      control_group=self.control_group.name,
+                      tier=self.tier.name,
                       cluster=self.jurisdiction.name)
 
             subnet = net_template.add_resource(ec2.Subnet(
@@ -483,7 +476,7 @@ class AWS(object):
                 AvailabilityZone=assign[1],
                 CidrBlock=assign[0],
                 MapPublicIpOnLaunch=True,
-                VpcId=ImportValue('{}-vpc-primary'.format(self.jurisdiction.parent.id)),
+                VpcId=ImportValue('{}-vpc-primary'.format(self.tier.id)),
                 Tags=tags
             ))
 
@@ -496,7 +489,7 @@ class AWS(object):
 
             subnet_rt_assoc = net_template.add_resource(ec2.SubnetRouteTableAssociation(
                 'Subnet{}RouteTableAssociation'.format(subnet_counter),
-                RouteTableId=ImportValue('{}-rt-primary'.format(self.jurisdiction.parent.id)),
+                RouteTableId=ImportValue('{}-rt-primary'.format(self.tier.id)),
                 SubnetId=Ref(subnet)
             ))
 
@@ -513,10 +506,10 @@ class AWS(object):
                             'IpProtocol': 'tcp'
                         }
                     ],
-                    VpcId=ImportValue('{}-vpc-primary'.format(self.jurisdiction.parent.id)),
+                    VpcId=ImportValue('{}-vpc-primary'.format(self.tier.id)),
                     Tags=Tags(Name='{}_sg_elb_controller'.format(self.jurisdiction.name),
-                              control_group=self.jurisdiction.parent.parent.name,
-                              tier=self.jurisdiction.parent.name,
+                              control_group=self.control_group.name,
+                              tier=self.tier.name,
                               cluster=self.jurisdiction.name)
                 ))
 
@@ -536,8 +529,8 @@ class AWS(object):
                         Ref(subnet)
                     ],
                     Tags=Tags(Name='{}_controller'.format(self.jurisdiction.name),
-                              control_group=self.jurisdiction.parent.parent.name,
-                              tier=self.jurisdiction.parent.name,
+                              control_group=self.control_group.name,
+                              tier=self.tier.name,
                               cluster=self.jurisdiction.name)
                 ))
 
@@ -548,16 +541,16 @@ class AWS(object):
                     Export=Export('{}-elb-controller'.format(self.jurisdiction.id))
                 ))
 
-                if self.jurisdiction.parent.configuration['dedicated_etcd']:
+                if self.jurisdiction.configuration['dedicated_etcd']:
                     security_group_elb_etcd = net_template.add_resource(ec2.SecurityGroup(
                         'SecurityGroupElbEtcd',
                         GroupDescription='Kubernetes etcd ELB security group',
                         SecurityGroupEgress=self.standard_egress,
                         SecurityGroupIngress=self.standard_ingress,
-                        VpcId=ImportValue('{}-vpc-primary'.format(self.jurisdiction.parent.id)),
+                        VpcId=ImportValue('{}-vpc-primary'.format(self.tier.id)),
                         Tags=Tags(Name='{}_sg_elb_etcd'.format(self.jurisdiction.name),
-                                  control_group=self.jurisdiction.parent.parent.name,
-                                  tier=self.jurisdiction.parent.name,
+                                  control_group=self.control_group.name,
+                                  tier=self.tier.name,
                                   cluster=self.jurisdiction.name)
                     ))
 
@@ -578,8 +571,8 @@ class AWS(object):
                             Ref(subnet)
                         ],
                         Tags=Tags(Name='{}_etcd'.format(self.jurisdiction.name),
-                                  control_group=self.jurisdiction.parent.parent.name,
-                                  tier=self.jurisdiction.parent.name,
+                                  control_group=self.control_group.name,
+                                  tier=self.tier.name,
                                   cluster=self.jurisdiction.name)
                     ))
 
@@ -596,9 +589,10 @@ class AWS(object):
 
         stack_name = 'ClusterNet{}'.format(str(self.jurisdiction.id).zfill(4))
 
-        cf_client = boto3.client('cloudformation', region_name=self.region)
+        cf_client = aws_clients.get('cloudformation', self.region)
         cf_stack = cf_client.create_stack(StackName=stack_name,
-                                          TemplateBody=net_template_content)
+                                          TemplateBody=net_template_content,
+                                          NotificationARNs=notification_arns(self.region))
 
         return {
             'cloudformation_stack': {
@@ -619,16 +613,16 @@ class AWS(object):
         cluster_ca, cluster_ca_key = self._generate_cluster_tls_assets()
 
         # ec2 key pair
-        ec2_client = boto3.client('ec2', region_name=self.region)
+        ec2_client = aws_clients.get('ec2', self.region)
         ec2_key_pair = ec2_client.create_key_pair(KeyName=self.jurisdiction.name)
         private_key_content = ec2_key_pair['KeyMaterial']
 
-        s3_client = boto3.client('s3', region_name=self.region)
+        s3_client = aws_clients.get('s3', self.region)
         private_key_filepath = '{0}/credentials/{0}.pem'.format(self.jurisdiction.name)
         self._save_to_s3(private_key_filepath, private_key_content)
 
         # kms key
-        kms_client = boto3.client('kms', region_name=self.region)
+        kms_client = aws_clients.get('kms', self.region)
         kms_key = kms_client.create_key(Description=self.jurisdiction.name)
         kms_key_arn = kms_key['KeyMetadata']['Arn']
 
@@ -642,7 +636,7 @@ class AWS(object):
         ami = image_ids.json()[self.region]['hvm']
 
         # load balancers
-        elb_client = boto3.client('elb', region_name=self.region)
+        elb_client = aws_clients.get('elb', self.region)
         load_balancers = {}
         marker = None
         elb_search_complete = False
@@ -661,7 +655,7 @@ class AWS(object):
                         load_balancers['controller'] = elb['DNSName']
                     elif tag['Key'] == 'Name' and tag['Value'] == '{}_etcd'.format(self.jurisdiction.name):
                         load_balancers['etcd'] = elb['DNSName']
-                if self.jurisdiction.parent.configuration['dedicated_etcd']:
+                if self.jurisdiction.configuration['dedicated_etcd']:
                     if len(load_balancers) == 2:
                         elb_search_complete = True
                         break
@@ -672,8 +666,8 @@ class AWS(object):
 
         # universal tags
         cluster_tags = {
-                'control_group': self.jurisdiction.parent.parent.name,
-                'tier': self.jurisdiction.parent.name,
+                'control_group': self.control_group.name,
+                'tier': self.tier.name,
                 'cluster': self.jurisdiction.name
             }
 
@@ -695,7 +689,7 @@ class AWS(object):
                     'IpProtocol': 'tcp'
                 }
             ],
-            VpcId=ImportValue('{}-vpc-primary'.format(self.jurisdiction.parent.id)),
+            VpcId=ImportValue('{}-vpc-primary'.format(self.tier.id)),
             Tags=Tags(**security_group_controller_tags)
         ))
 
@@ -717,13 +711,13 @@ class AWS(object):
             SecurityGroupEgress=self.standard_egress,
             SecurityGroupIngress=self.standard_ingress + [
                 {
-                    'CidrIp': self.jurisdiction.parent.parent.configuration['control_cluster_cidr'],
+                    'CidrIp': self.jurisdiction.configuration['control_cluster_cidr'],
                     'FromPort': 30900,
                     'ToPort': 30900,
                     'IpProtocol': 'tcp'
                 }
             ],
-            VpcId=ImportValue('{}-vpc-primary'.format(self.jurisdiction.parent.id)),
+            VpcId=ImportValue('{}-vpc-primary'.format(self.tier.id)),
             Tags=Tags(**security_group_worker_tags)
         ))
 
@@ -790,7 +784,7 @@ class AWS(object):
             SourceSecurityGroupId=Ref(security_group_controller)
         ))
 
-        if self.jurisdiction.parent.configuration['dedicated_etcd']:
+        if self.jurisdiction.configuration['dedicated_etcd']:
             security_group_etcd_tags = {
                     'Name': '{}_etcd'.format(self.jurisdiction.name)
                 }
@@ -801,7 +795,7 @@ class AWS(object):
                 GroupDescription='Kubernetes etcd node security group',
                 SecurityGroupEgress=self.standard_egress,
                 SecurityGroupIngress=self.standard_ingress,
-                VpcId=ImportValue('{}-vpc-primary'.format(self.jurisdiction.parent.id)),
+                VpcId=ImportValue('{}-vpc-primary'.format(self.tier.id)),
                 Tags=Tags(**security_group_etcd_tags)
             ))
 
@@ -936,7 +930,7 @@ class AWS(object):
             ],
             IamInstanceProfile=Ref(iam_instance_profile_worker),
             ImageId=ami,
-            InstanceType=self.jurisdiction.parent.configuration['worker_instance_type'],
+            InstanceType=self.jurisdiction.configuration['worker_instance_type'],
             KeyName=self.jurisdiction.name,
             SecurityGroups=[Ref(security_group_worker)],
             UserData=self._generate_userdata('worker', kms_key_arn,
@@ -947,7 +941,7 @@ class AWS(object):
         rolling_update_policy_worker = policies.AutoScalingRollingUpdate(
             'RollingUpdatePolicyWorker',
             MaxBatchSize=1,
-            MinInstancesInService=self.jurisdiction.parent.configuration['initial_workers'],
+            MinInstancesInService=self.jurisdiction.configuration['initial_workers'],
             PauseTime='PT5M'
         )
 
@@ -961,9 +955,9 @@ class AWS(object):
             HealthCheckGracePeriod=600,
             HealthCheckType='EC2',
             LaunchConfigurationName=Ref(launch_config_worker),
-            DesiredCapacity=self.jurisdiction.parent.configuration['initial_workers'],
-            MaxSize=self.jurisdiction.parent.configuration['initial_workers'] * 2,
-            MinSize=self.jurisdiction.parent.configuration['initial_workers'],
+            DesiredCapacity=self.jurisdiction.configuration['initial_workers'],
+            MaxSize=self.jurisdiction.configuration['initial_workers'] * 2,
+            MinSize=self.jurisdiction.configuration['initial_workers'],
             VPCZoneIdentifier=[ImportValue('{}-subnet-{}'.format(self.jurisdiction.id, next(itertools.count()))) for cidr in self.jurisdiction.configuration['host_subnet_cidrs']],
             UpdatePolicy=rolling_update_policy_worker,
             Tags=autoscaling.Tags(**auto_scale_worker_tags)
@@ -1059,7 +1053,7 @@ class AWS(object):
                 ],
                 IamInstanceProfile=Ref(iam_instance_profile_controller),
                 ImageId=ami,
-                InstanceType=self.jurisdiction.parent.configuration['controller_instance_type'],
+                InstanceType=self.jurisdiction.configuration['controller_instance_type'],
                 KeyName=self.jurisdiction.name,
                 NetworkInterfaces=[
                     network_iface_controller
@@ -1096,8 +1090,8 @@ class AWS(object):
 
         etcd_refs = []
         etcd_count = 0
-        if self.jurisdiction.parent.configuration['dedicated_etcd']:
-            for ip in self.jurisdiction.parent.configuration['etcd_ips']:
+        if self.jurisdiction.configuration['dedicated_etcd']:
+            for ip in self.jurisdiction.configuration['etcd_ips']:
                 etcd_name = '{}_etcd_{}'.format(self.jurisdiction.name, etcd_count)
 
                 network_iface_etcd = ec2.NetworkInterfaceProperty(
@@ -1129,7 +1123,7 @@ class AWS(object):
                     ],
                     IamInstanceProfile=Ref(iam_instance_profile_controller),
                     ImageId=ami,
-                    InstanceType=self.jurisdiction.parent.configuration['etcd_instance_type'],
+                    InstanceType=self.jurisdiction.configuration['etcd_instance_type'],
                     KeyName=self.jurisdiction.name,
                     NetworkInterfaces=[
                         network_iface_etcd
@@ -1184,10 +1178,11 @@ class AWS(object):
 
         stack_name = 'ClusterNodes{}'.format(str(self.jurisdiction.id).zfill(4))
 
-        cf_client = boto3.client('cloudformation', region_name=self.region)
+        cf_client = aws_clients.get('cloudformation', self.region)
         cf_stack = cf_client.create_stack(StackName=stack_name,
                                           TemplateBody=node_template_content,
-                                          Capabilities=['CAPABILITY_IAM'])
+                                          Capabilities=['CAPABILITY_IAM'],
+                                          NotificationARNs=notification_arns(self.region))
 
         return {
             'cloudformation_stack': {
@@ -1204,7 +1199,7 @@ class AWS(object):
     def register_elb_instances(self):
 
         # collect required export names
-        cf_client = boto3.client('cloudformation', region_name=self.region)
+        cf_client = aws_clients.get('cloudformation', self.region)
 
         controller_elb_name = '{}-elb-controller'.format(self.jurisdiction.id)
         controller_sg_name = '{}-security-group-controller'.format(self.jurisdiction.id)
@@ -1217,7 +1212,7 @@ class AWS(object):
                                                               ip.replace('.', '-'))
             required_exports[instance_key] = None
 
-        if self.jurisdiction.parent.configuration['dedicated_etcd']:
+        if self.jurisdiction.configuration['dedicated_etcd']:
             etcd_elb_name = '{}-elb-etcd'.format(self.jurisdiction.id)
             etcd_sg_name = '{}-security-group-etcd'.format(self.jurisdiction.id)
             etcd_required_exports = {
@@ -1256,7 +1251,7 @@ class AWS(object):
                 complete = True
 
         # register instances with ELBs
-        elb_client = boto3.client('elb', region_name=self.region)
+        elb_client = aws_clients.get('elb', self.region)
 
         controller_instances = []
         for export in required_exports:
@@ -1266,7 +1261,7 @@ class AWS(object):
                         LoadBalancerName=required_exports[controller_elb_name],
                         Instances=controller_instances)
 
-        if self.jurisdiction.parent.configuration['dedicated_etcd']:
+        if self.jurisdiction.configuration['dedicated_etcd']:
             etcd_instances = []
             for export in required_exports:
                 if 'instance-etcd' in export:
@@ -1275,43 +1270,28 @@ class AWS(object):
                             LoadBalancerName=required_exports[etcd_elb_name],
                             Instances=etcd_instances)
 
-    def provision_cluster(self):
-
-        assets = self.provision_cluster_network()
-        monitor_cloudformation_stack.delay(self.jurisdiction.id,
-                                           interim_operation=True,
-                                           stack_key='network')
-        monitor_cluster_network.delay(self.jurisdiction.id)
-        monitor_cluster_nodes.delay(self.jurisdiction.id)
-
-        return assets
-
     def decommission_jurisdiction(self):
 
-        cf_client = boto3.client('cloudformation', region_name=self.region)
+        cf_client = aws_clients.get('cloudformation', self.region)
 
-        if self.jurisdiction.jurisdiction_type.name == 'cluster':
-            ec2_client = boto3.client('ec2', region_name=self.region)
+        if self.jurisdiction.type == 'cluster':
+            ec2_client = aws_clients.get('ec2', self.region)
             ec2_client.delete_key_pair(
                 KeyName=self.jurisdiction.assets['ec2_key_pair'])
 
-            kms_client = boto3.client('kms', region_name=self.region)
+            kms_client = aws_clients.get('kms', self.region)
             kms_client.delete_alias(
                     AliasName='alias/{}'.format(self.jurisdiction.name))
             kms_client.schedule_key_deletion(
                     KeyId=self.jurisdiction.assets['kms_key'])
 
-            net_stack_id = self.jurisdiction.assets['cloudformation_stack']['network']['stack_id']
-            nodes_stack_id = self.jurisdiction.assets['cloudformation_stack']['nodes']['stack_id']
-
-            cf_client.delete_stack(StackName=nodes_stack_id)
+            cf_client.delete_stack(StackName=self.jurisdiction.stacks['nodes'])
 
-            monitor_decommission.delay(self.jurisdiction.id,
-                                       nodes_stack_id, net_stack_id)
+            poll_later(monitor_decommission, self.jurisdiction.as_dict())
 
         else:
-            if self.jurisdiction.jurisdiction_type.name == 'control_group':
-                s3_client = boto3.client('s3', region_name=self.region)
+            if self.jurisdiction.type == 'control_group':
+                s3_client = aws_clients.get('s3', self.region)
                 objects = s3_client.list_objects_v2(
                                 Bucket=self.jurisdiction.assets['s3_bucket'])
                 bucket_contents = objects.get('Contents')
@@ -1325,8 +1305,7 @@ class AWS(object):
                                     'Objects': delete
                                 })
 
-            cf_client.delete_stack(
-                StackName=self.jurisdiction.assets['cloudformation_stack']['stack_id'])
+            cf_client.delete_stack(StackName=self.jurisdiction.stacks[Stack.MAIN])
 
         return {}
 
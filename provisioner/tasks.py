@@ -1,15 +1,23 @@
+import datetime
+import logging
 import os
-import time
 
-import boto3
 import celery
+import sqlalchemy
+from botocore.exceptions import ClientError
 from celery import Celery
-from sqlalchemy.orm.attributes import flag_modified
+from celery.signals import worker_process_init
+from sqlalchemy.orm import aliased, joinedload
 
-from provisioner import db
-from provisioner.models import Jurisdiction
+from provisioner import aws_clients, db
+from provisioner.events import event_queue, parse_stack_event, utc_timestamp
+from provisioner.models import Jurisdiction, JurisdictionSnapshot, Operation, Stack
+from provisioner.models import WorkflowStep
+from provisioner.workflows import WORKFLOWS, WORKFLOW_STACK_KEYS
 
 
+logger = logging.getLogger(__name__)
+
 mq = Celery('tasks', broker='amqp://{0}:{1}@{2}//'.format(
                                     os.environ.get('RABBITMQ_DEFAULT_USER'),
                                     os.environ.get('RABBITMQ_DEFAULT_PASS'),
@@ -17,151 +25,643 @@ mq = Celery('tasks', broker='amqp://{0}:{1}@{2}//'.format(
 mq.conf.update(CELERY_TASK_SERIALIZER = 'json')
 mq.conf.update(CELERY_RESULT_SERIALIZER = 'json')
 
+# seconds between checks of infrastructure being monitored
+POLL_INTERVAL = 30
+
+# checks after which a monitor gives up
+MAX_CHECKS = 30
+
+# seconds between drains of the stack event queue, if there is one
+EVENT_INTERVAL = 5
+
+# messages after which a drain of the stack event queue stops
+MAX_EVENTS = 500
+
+# seconds after which a workflow step that has not advanced is resumed
+STEP_TIMEOUT = 600
+
+# seconds after which an operation still pending or running is recovered
+OPERATION_TIMEOUT = 600
+
+mq.conf.update(CELERYBEAT_SCHEDULE={
+    'sweep-stacks': {
+        'task': 'provisioner.tasks.sweep_stacks',
+        'schedule': datetime.timedelta(seconds=POLL_INTERVAL)
+    },
+    'resume-workflows': {
+        'task': 'provisioner.tasks.resume_workflows',
+        'schedule': datetime.timedelta(seconds=POLL_INTERVAL)
+    },
+    'resume-operations': {
+        'task': 'provisioner.tasks.resume_operations',
+        'schedule': datetime.timedelta(seconds=POLL_INTERVAL)
+    }
+})
+# the queue itself is only created by the task, so that importing the tasks
+# never creates an AWS client
+if os.environ.get('STACK_EVENTS_QUEUE_URL') or os.environ.get('STACK_EVENTS_FILE'):
+    mq.conf.CELERYBEAT_SCHEDULE['consume-stack-events'] = {
+        'task': 'provisioner.tasks.consume_stack_events',
+        'schedule': datetime.timedelta(seconds=EVENT_INTERVAL)
+    }
+
+# stack statuses that are not yet final, by which listings are filtered
+IN_PROGRESS_STATUSES = [
+    'CREATE_IN_PROGRESS', 'DELETE_IN_PROGRESS', 'REVIEW_IN_PROGRESS',
+    'ROLLBACK_IN_PROGRESS', 'UPDATE_IN_PROGRESS',
+    'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_IN_PROGRESS',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS'
+]
+
+# sets the status of stacks from parallel arrays of stack ids, statuses and
+# the times they were seen, returning the stacks whose status changed. A
+# status is only applied if it was seen after the stack's current status so
+# that late events never undo newer changes. clock_timestamp() is used
+# rather than now() so that a change is not dated to the start of a
+# transaction that waited on a lock.
+STACK_STATUS_UPDATE = sqlalchemy.text("""
+    UPDATE stack SET status = changed.status, status_at = changed.status_at,
+                     updated_at = clock_timestamp()
+    FROM unnest(CAST(:stack_ids AS TEXT[]), CAST(:statuses AS TEXT[]),
+                CAST(:status_ats AS TIMESTAMPTZ[]))
+         AS changed(stack_id, status, status_at)
+    WHERE stack.stack_id = changed.stack_id
+    AND stack.status IS DISTINCT FROM changed.status
+    AND (stack.status_at IS NULL OR stack.status_at < changed.status_at)
+    RETURNING stack.jurisdiction_id, stack.key, stack.status
+""")
+
+
+@worker_process_init.connect
+def dispose_inherited_connections(**kwargs):
+    """Ensure each worker process opens its own database connections"""
+    db.dispose()
+
+
+def poll_later(task, *args, **kwargs):
+    """
+    Enqueue a monitor task to check on infrastructure again after
+    POLL_INTERVAL seconds. Monitors check once and carry their state to the
+    next check in the message instead of sleeping, so that they never hold
+    a worker while they wait.
+    """
+    task.apply_async(args, kwargs, countdown=POLL_INTERVAL)
+
+
+@db.retried()
+def save_assets(session, jurisdiction_id, assets, region):
+    """
+    Save the assets returned by a platform to a jurisdiction. Cloudformation
+    stacks are saved to the jurisdiction's stacks and the remaining assets
+    are merged into its assets. Retried if the jurisdiction is updated
+    concurrently so that no other task's assets are lost. Returns the ids of
+    the jurisdiction's stacks by key.
+    """
+    jurisdiction = session.query(Jurisdiction)\
+                          .options(joinedload(Jurisdiction.stacks))\
+                          .filter_by(id=jurisdiction_id).one()
+
+    assets = dict(assets)
+    stacks = assets.pop('cloudformation_stack', {})
+    if 'stack_id' in stacks:
+        stacks = {Stack.MAIN: stacks}
+
+    existing = {s.key: s for s in jurisdiction.stacks}
+    for key, stack in stacks.items():
+        if key not in existing:
+            existing[key] = Stack(key=key)
+            jurisdiction.stacks.append(existing[key])
+        existing[key].stack_id = stack['stack_id']
+        existing[key].region = region
+        existing[key].status = stack['status']
+
+    merged = dict(jurisdiction.assets or {})
+    merged.update(assets)
+    jurisdiction.assets = merged
+
+    return {key: s.stack_id for key, s in existing.items()}
+
+
+def activate(session, jurisdiction_ids):
+    """
+    Mark jurisdictions active. The version is incremented in the same
+    statement so the update never conflicts and needs no retry.
+    """
+    session.query(Jurisdiction).filter(Jurisdiction.id.in_(jurisdiction_ids))\
+           .update({'active': True, 'version': Jurisdiction.version + 1},
+                   synchronize_session=False)
+
+
+def start_workflow(session, jurisdiction_id, workflow, operation_id=None):
+    """
+    Save the steps of a workflow for a jurisdiction from its definition,
+    replacing those of an earlier run of the workflow that failed or
+    completed. The steps are linked to the operation that started the
+    workflow, if any, so that it fails if a step fails. Raises RuntimeError
+    if the workflow is still running for the jurisdiction.
+    """
+    if unfinished_steps(session, jurisdiction_id).filter_by(workflow=workflow).first():
+        raise RuntimeError('Workflow {0} of jurisdiction with id {1} is in progress'.format(
+                               workflow, jurisdiction_id))
+
+    session.query(WorkflowStep)\
+           .filter_by(jurisdiction_id=jurisdiction_id, workflow=workflow)\
+           .delete(synchronize_session=False)
+    for step in WORKFLOWS[workflow]:
+        session.add(WorkflowStep(jurisdiction_id=jurisdiction_id,
+                                 workflow=workflow,
+                                 name=step.name,
+                                 depends_on=list(step.depends_on),
+                                 action=step.action,
+                                 stack_key=step.stack_key,
+                                 operation_id=operation_id))
+
+
+def unfinished_steps(session, jurisdiction_id):
+    """
+    Build a query for the steps of a jurisdiction's workflows that are still
+    to run or running, ignoring those of workflows that have failed
+    """
+    failed = session.query(WorkflowStep.workflow)\
+                    .filter_by(jurisdiction_id=jurisdiction_id, status='failed')
+    return session.query(WorkflowStep)\
+                  .filter(WorkflowStep.jurisdiction_id == jurisdiction_id,
+                          WorkflowStep.status.in_(('waiting', 'running')),
+                          ~WorkflowStep.workflow.in_(failed.subquery()))
+
+
+def advance_steps(steps, stack_statuses):
+    """
+    Advance the steps of a jurisdiction's workflows given the statuses of
+    its stacks by key. Running steps whose stack was created are complete and
+    those whose stack was not are failed. Waiting steps whose dependencies
+    are all complete are marked running, unless a step of their workflow has
+    failed. Returns the ids of the steps to start.
+    """
+    for step in steps:
+        if step.status == 'running' and step.stack_key:
+            status = stack_statuses.get(step.stack_key)
+            if status == 'CREATE_COMPLETE':
+                step.status = 'complete'
+            elif status not in (None, 'CREATE_IN_PROGRESS'):
+                step.status = 'failed'
+                step.message = 'Stack {} is {}'.format(step.stack_key, status)
+
+    complete = {(s.workflow, s.name) for s in steps if s.status == 'complete'}
+    failed = {s.workflow for s in steps if s.status == 'failed'}
+
+    started = []
+    for step in steps:
+        if step.status == 'waiting' and step.workflow not in failed and \
+           all((step.workflow, d) in complete for d in step.depends_on):
+            step.status = 'running'
+            started.append(step.id)
+
+    return started
+
+
+def fail_operations(session, steps):
+    """
+    Mark failed the operations that started the workflows of failed steps,
+    with the message of the step that failed. An operation completes once
+    its workflow has started, so it may already be complete.
+    """
+    for step in steps:
+        if step.status == 'failed' and step.operation_id:
+            msg = 'Step {0} of workflow {1} failed: {2}'.format(step.name, step.workflow,
+                                                                step.message)
+            session.query(Operation)\
+                   .filter(Operation.id == step.operation_id, Operation.status != 'failed')\
+                   .update({'status': 'failed', 'message': msg},
+                           synchronize_session=False)
+
+
+STEP_ACTIONS = {}
+
+
+def step_action(func):
+    """Register a function as a workflow step action by its name"""
+    STEP_ACTIONS[func.__name__] = func
+    return func
+
+
+@step_action
+def provision_cluster_network(snapshot):
+    from provisioner.platforms import AWS
+
+    save_assets(snapshot.id, AWS(snapshot).provision_cluster_network(),
+                snapshot.region)
+
+
+@step_action
+def provision_cluster_nodes(snapshot):
+    from provisioner.platforms import AWS
+
+    save_assets(snapshot.id, AWS(snapshot).provision_cluster_nodes(),
+                snapshot.region)
+
+
+@step_action
+def register_elb_instances(snapshot):
+    from provisioner.platforms import AWS
+
+    AWS(snapshot).register_elb_instances()
+
+
+@step_action
+def activate_jurisdiction(snapshot):
+    with db.transaction() as session:
+        activate(session, [snapshot.id])
+
+
+def record_stack_statuses(session, statuses):
+    """
+    Save the latest statuses of stacks in one statement and mark active the
+    jurisdictions whose main stack was created or updated. Statuses are
+    given by stack id as pairs of status and the UTC timestamp at which it
+    was seen. Statuses that have not changed or were seen before the stack's
+    current status are not written. Returns the jurisdiction id, key and
+    status of the stacks that changed.
+    """
+    if not statuses:
+        return []
+
+    stack_ids = list(statuses)
+    changed = session.execute(STACK_STATUS_UPDATE,
+                              {'stack_ids': stack_ids,
+                               'statuses': [statuses[s][0] for s in stack_ids],
+                               'status_ats': [statuses[s][1] for s in stack_ids]})\
+                     .fetchall()
+
+    completed = [s.jurisdiction_id for s in changed
+                 if s.key == Stack.MAIN and
+                 s.status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE')]
+    if completed:
+        activate(session, completed)
+
+    return changed
+
+
+def advance_workflows(changed):
+    """
+    Advance the workflows of jurisdictions with changed stacks that
+    workflow steps are waiting on. Called once the changes are committed.
+    """
+    for jurisdiction_id in {s.jurisdiction_id for s in changed
+                            if s.key in WORKFLOW_STACK_KEYS}:
+        advance_workflow.delay(jurisdiction_id)
+
+
+def in_progress():
+    """Return a filter on stacks whose latest status is not yet final"""
+    return sqlalchemy.or_(Stack.status == None,
+                          Stack.status.endswith('IN_PROGRESS'))
+
+
+def cloudformation_statuses(region, stack_ids):
+    """
+    Return the statuses of cloudformation stacks in a region by stack id.
+    Only the region's stacks in progress are listed, a page at a time until
+    all have been seen, and those not listed, having finished, are described.
+    A stack that cloudformation does not know of, e.g. one deleted out of
+    band, is deleted. A stack that fails to be described is left out, so
+    that one stack never keeps the region's others from being updated.
+    """
+    cf_client = aws_clients.get('cloudformation', region)
+    remaining = set(stack_ids)
+    statuses = {}
+
+    pages = cf_client.get_paginator('list_stacks')\
+                     .paginate(StackStatusFilter=IN_PROGRESS_STATUSES)
+    for page in pages:
+        for summary in page['StackSummaries']:
+            if summary['StackId'] in remaining:
+                statuses[summary['StackId']] = summary['StackStatus']
+                remaining.discard(summary['StackId'])
+        if not remaining:
+            break
+
+    for stack_id in remaining:
+        try:
+            cf_stack = cf_client.describe_stacks(StackName=stack_id)
+        except ClientError as e:
+            if 'does not exist' in e.response['Error'].get('Message', ''):
+                statuses[stack_id] = 'DELETE_COMPLETE'
+            else:
+                logger.warning('Stack %s could not be described: %s', stack_id, e)
+            continue
+        statuses[stack_id] = cf_stack['Stacks'][0]['StackStatus']
+
+    return statuses
+
 
 @mq.task
-def monitor_cloudformation_stack(jurisdiction_id, interim_operation=False,
-                                 stack_key=None):
+def sweep_stacks():
     """
-    Checks on status of clouformation staxck every 30 seconds and updates status.
-    When cloudformation creation or update is complete, it also updates
-    active attribute to True. If interim_operation argument is set to True
-    the jurisdiction will *not* be marked active.
+    Start a sweep of each region with stacks in progress. Run by celery beat
+    every POLL_INTERVAL seconds.
     """
     with db.transaction() as session:
-        j = session.query(Jurisdiction).filter_by(id=jurisdiction_id).one()
+        regions = session.query(Stack.region).filter(in_progress())\
+                         .distinct().all()
 
-        j_assets = j.assets
-        if stack_key:
-            j_stack_id = j.assets['cloudformation_stack'][stack_key]['stack_id']
-        else:
-            j_stack_id = j.assets['cloudformation_stack']['stack_id']
-        j_type = j.jurisdiction_type.name
-        if j_type == 'control_group':
-            region = j.configuration['region']
-        elif j_type == 'tier':
-            region = j.parent.configuration['region']
-        elif j_type == 'cluster':
-            region = j.parent.parent.configuration['region']
-
-    complete = False
-    checks = 0
-    status = None
-    while not complete:
-        time.sleep(30)
-        cf_client = boto3.client('cloudformation', region_name=region)
-        cf_stack = cf_client.describe_stacks(StackName=j_stack_id)
-        latest_status = cf_stack['Stacks'][0]['StackStatus']
-        if latest_status != status:
-            with db.transaction() as session:
-                j = session.query(Jurisdiction).filter_by(id=jurisdiction_id).one()
-                assets = j.assets
-                if stack_key:
-                    assets['cloudformation_stack'][stack_key]['status'] = latest_status
-                else:
-                    assets['cloudformation_stack']['status'] = latest_status
-                j.assets = assets
-                flag_modified(j, 'assets')
-                if latest_status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
-                    if not interim_operation:
-                        j.active = True
-                    complete = True
-                elif latest_status[-6:] == 'FAILED':
-                    complete = True
-            status = latest_status
-            checks += 1
-            if checks > 30:
-                complete = True
+    for region, in regions:
+        sweep_region.delay(region)
 
 
 @mq.task
-def monitor_cluster_network(jurisdiction_id):
+def sweep_region(region):
     """
-    Monitor the readiness of a cluster's network components during cluster
-    provisioning. Once cluster network componenets are ready, cluster nodes
-    can be provisioned.
+    Update the status of every stack in progress in a region from one
+    listing of the region's stacks in progress and write all of the changes
+    in one statement. Jurisdictions whose main stack was created or updated
+    are marked active. No transaction is open while cloudformation is
+    called. The write is skipped if another sweep of the region is writing,
+    as its statuses are at least as recent.
     """
-    network_ready = False
-    checks = 0
-    while not network_ready:
-        time.sleep(30)
-        with db.transaction() as session:
-            j = session.query(Jurisdiction).filter_by(id=jurisdiction_id).one()
-            if j.parent.parent.configuration['platform'] == 'amazon_web_services':
-                from provisioner.platforms import AWS
-                if j.assets['cloudformation_stack']['network']['status'] == 'CREATE_COMPLETE':
-                    network_ready = True
-                    platform = AWS(j)
-                    node_assets = platform.provision_cluster_nodes()
-                    node_stack = node_assets.pop('cloudformation_stack')
-                    assets = j.assets
-                    assets['cloudformation_stack'].update(node_stack)
-                    assets.update(node_assets)
-                    j.assets = assets
-                    flag_modified(j, 'assets')
-                    monitor_cloudformation_stack.delay(jurisdiction_id,
-                                                       interim_operation=True,
-                                                       stack_key='nodes')
-                else:
-                    checks += 1
-                    if checks > 30:
-                        network_ready = True
+    with db.transaction() as session:
+        stack_ids = [stack_id for stack_id, in
+                     session.query(Stack.stack_id)
+                            .filter(Stack.region == region, in_progress())]
+    if not stack_ids:
+        return
+
+    # taken before the listing so that no event of a later change is
+    # mistaken for an earlier one
+    seen_at = utc_timestamp()
+    statuses = {stack_id: (status, seen_at) for stack_id, status
+                in cloudformation_statuses(region, stack_ids).items()}
+
+    with db.transaction() as session:
+        if not db.try_lock_region(session, region):
+            return
+        changed = record_stack_statuses(session, statuses)
+
+    advance_workflows(changed)
 
 
 @mq.task
-def monitor_cluster_nodes(jurisdiction_id):
+def consume_stack_events():
+    """
+    Drain the stack event queue, saving the latest status of each stack
+    notified in one statement along with the time of its event, so that an
+    event drained after a newer one is ignored. Messages are deleted once
+    the statuses are committed so that none are lost if the worker fails.
+    Run by celery beat every EVENT_INTERVAL seconds when there is a queue
+    and does nothing if there is none.
+    The stack sweep still catches any change whose event is lost.
+    """
+    queue = event_queue()
+    if queue is None:
+        return
+
+    handles = []
+    events = {}
+
+    messages = queue.receive()
+    while messages and len(handles) < MAX_EVENTS:
+        for handle, body in messages:
+            handles.append(handle)
+            event = parse_stack_event(body)
+            if event:
+                stack_id, status, timestamp = event
+                # notifications may arrive out of order
+                if stack_id not in events or events[stack_id][1] < timestamp:
+                    events[stack_id] = (status, timestamp)
+        messages = queue.receive()
+
+    with db.transaction() as session:
+        changed = record_stack_statuses(session, events)
+
+    queue.delete(handles)
+    advance_workflows(changed)
+
+
+@mq.task(acks_late=True)
+def provision_jurisdiction(operation_id):
+    """
+    Carry out a provisioning operation started by the API. Provisions the
+    operation's jurisdiction on its platform and saves the resulting assets,
+    or for a cluster starts the provision_cluster workflow. The operation is
+    marked complete once provisioning has been started or failed if an error
+    occurs or, later, if a step of the workflow fails. Acknowledged once done
+    so that the message is redelivered if its worker is lost, but only a
+    pending operation is carried out so that none is carried out twice.
+    """
+    from provisioner.platforms import AWS
+
+    with db.transaction() as session:
+        op = session.query(Operation).filter_by(id=operation_id)\
+                    .with_for_update().one()
+        if op.status != 'pending':
+            return
+        op.status = 'running'
+
+    try:
+        with db.transaction() as session:
+            op = session.query(Operation).filter_by(id=operation_id).one()
+            # the lock is only held while the jurisdiction is read; the
+            # running operation keeps requests from changing its
+            # infrastructure until the platform returns
+            if not db.try_lock_jurisdiction(session, op.jurisdiction_id):
+                raise RuntimeError('Jurisdiction with id {} is being provisioned or '
+                                   'decommissioned'.format(op.jurisdiction_id))
+            snapshot = Jurisdiction.load_with_lineage(session, op.jurisdiction_id)\
+                                   .snapshot()
+            if snapshot.type == 'cluster':
+                start_workflow(session, snapshot.id, 'provision_cluster', operation_id)
+
+        platform = AWS(snapshot)
+        if snapshot.type == 'control_group':
+            assets = platform.provision_control_group()
+        elif snapshot.type == 'tier':
+            assets = platform.provision_tier()
+        else:
+            assets = None
+
+        if assets:
+            save_assets(snapshot.id, assets, snapshot.region)
+
+        with db.transaction() as session:
+            # unless it was given up on in the meantime
+            session.query(Operation).filter_by(id=operation_id, status='running')\
+                   .update({'status': 'complete'}, synchronize_session=False)
+    except Exception as e:
+        with db.transaction() as session:
+            op = session.query(Operation).filter_by(id=operation_id).one()
+            op.status = 'failed'
+            op.message = str(e)
+        raise
+
+    if snapshot.type == 'cluster':
+        advance_workflow.delay(snapshot.id)
+
+
+@mq.task(acks_late=True)
+def advance_workflow(jurisdiction_id):
+    """
+    Advance the workflows of a jurisdiction after one of its steps finishes
+    or the status of one of its stacks changes, starting each step whose
+    dependencies are now complete and failing the operations of workflows
+    whose steps failed. The steps are locked so that concurrent advances
+    never start a step twice. Nothing waits in between, so no worker is held
+    while a step's stack is created. Acknowledged once done so that the
+    advance is redelivered if its worker is lost.
+    """
+    with db.transaction() as session:
+        steps = session.query(WorkflowStep)\
+                       .filter_by(jurisdiction_id=jurisdiction_id)\
+                       .order_by(WorkflowStep.id)\
+                       .with_for_update().all()
+        if not steps:
+            return
+        stack_statuses = dict(session.query(Stack.key, Stack.status)
+                                     .filter_by(jurisdiction_id=jurisdiction_id))
+        started = advance_steps(steps, stack_statuses)
+        fail_operations(session, steps)
+
+    for step_id in started:
+        run_workflow_step.delay(step_id)
+
+
+@mq.task(acks_late=True)
+def run_workflow_step(step_id):
     """
-    Monitor the readiness of the cluster's nodes during cluster provisioning.
-    Once the nodes are ready, the controller/s can be attached to the load
-    balancer/s.
+    Run the action of a workflow step that has been started. A step that
+    creates a stack stays running until the stack's status advances the
+    workflow while any other step is complete once its action returns. The
+    step and the operation that started its workflow are failed if its
+    action raises. Acknowledged once done so that the step is run again if
+    its worker is lost, unless it is no longer running or its stack has
+    been saved.
     """
-    nodes_ready = False
-    checks = 0
-    while not nodes_ready:
-        time.sleep(30)
+    with db.transaction() as session:
+        step = session.query(WorkflowStep).filter_by(id=step_id).first()
+        if not step or step.status != 'running':
+            return
+        jurisdiction_id, action, stack_key = step.jurisdiction_id, step.action, step.stack_key
+        if stack_key and session.query(Stack.id)\
+                                .filter_by(jurisdiction_id=jurisdiction_id, key=stack_key)\
+                                .first():
+            return
+        snapshot = Jurisdiction.load_with_lineage(session, jurisdiction_id).snapshot()
+
+    try:
+        STEP_ACTIONS[action](snapshot)
+    except Exception as e:
+        with db.transaction() as session:
+            step = session.query(WorkflowStep).filter_by(id=step_id, status='running')\
+                          .with_for_update().first()
+            if step:
+                step.status = 'failed'
+                step.message = str(e)
+                fail_operations(session, [step])
+        raise
+
+    if not stack_key:
         with db.transaction() as session:
-            j = session.query(Jurisdiction).filter_by(id=jurisdiction_id).one()
-            if j.parent.parent.configuration['platform'] == 'amazon_web_services':
-                from provisioner.platforms import AWS
-                if 'nodes' in j.assets['cloudformation_stack']:
-                    if j.assets['cloudformation_stack']['nodes']['status'] == 'CREATE_COMPLETE':
-                        nodes_ready = True
-                        platform = AWS(j)
-                        platform.register_elb_instances()
-                        j.active = True
-                    else:
-                        checks += 1
-                        if checks > 30:
-                            nodes_ready = True
-                else:
-                    checks += 1
-                    if checks > 30:
-                        nodes_ready = True
+            session.query(WorkflowStep).filter_by(id=step_id, status='running')\
+                   .update({'status': 'complete'}, synchronize_session=False)
+        advance_workflow.delay(jurisdiction_id)
+
+
+@mq.task
+def resume_workflows():
+    """
+    Resume the workflows whose unfinished steps have not advanced for
+    STEP_TIMEOUT seconds, as when a worker was lost or a message was never
+    sent. Running steps whose stack has not been saved are run again and the
+    workflows are advanced in case a step finished or a stack changed
+    without advancing them. Run by celery beat every POLL_INTERVAL seconds.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=STEP_TIMEOUT)
+    failed = aliased(WorkflowStep, name='failed')
+
+    with db.transaction() as session:
+        steps = session.query(WorkflowStep)\
+                       .filter(WorkflowStep.status.in_(('waiting', 'running')),
+                               WorkflowStep.updated_on < cutoff,
+                               ~session.query(failed)
+                                       .filter(failed.jurisdiction_id == WorkflowStep.jurisdiction_id,
+                                               failed.workflow == WorkflowStep.workflow,
+                                               failed.status == 'failed')
+                                       .exists())\
+                       .with_for_update().all()
+        if not steps:
+            return
+
+        saved = set(session.query(Stack.jurisdiction_id, Stack.key)
+                           .filter(Stack.jurisdiction_id.in_([s.jurisdiction_id for s in steps])))
+        rerun = [s.id for s in steps if s.status == 'running' and
+                 (s.jurisdiction_id, s.stack_key) not in saved]
+        jurisdiction_ids = {s.jurisdiction_id for s in steps}
+        for step in steps:
+            # not resumed again until another STEP_TIMEOUT has passed
+            step.updated_on = datetime.datetime.utcnow()
+
+    for step_id in rerun:
+        run_workflow_step.delay(step_id)
+    for jurisdiction_id in jurisdiction_ids:
+        advance_workflow.delay(jurisdiction_id)
+
+
+@mq.task
+def resume_operations():
+    """
+    Recover the provisioning operations that have been pending or running
+    for OPERATION_TIMEOUT seconds, so that a jurisdiction is never kept from
+    being provisioned again by an operation that will not finish. A pending
+    operation, whose message was lost or never sent, is sent again. A
+    running operation whose worker was lost after its workflow started is
+    complete, as the workflow carries on without it, and otherwise is failed
+    since its platform may have been partly provisioned. Run by celery beat
+    every POLL_INTERVAL seconds.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=OPERATION_TIMEOUT)
+
+    with db.transaction() as session:
+        ops = session.query(Operation)\
+                     .filter(Operation.action == 'provision',
+                             Operation.status.in_(('pending', 'running')),
+                             Operation.updated_on < cutoff)\
+                     .with_for_update().all()
+        if not ops:
+            return
+
+        started = set(op_id for op_id, in
+                      session.query(WorkflowStep.operation_id)
+                             .filter(WorkflowStep.operation_id.in_([op.id for op in ops]))
+                             .distinct())
+        resent = []
+        for op in ops:
+            if op.status == 'pending':
+                resent.append(op.id)
+                # not sent again until another OPERATION_TIMEOUT has passed
+                op.updated_on = datetime.datetime.utcnow()
+            elif op.id in started:
+                op.status = 'complete'
+            else:
+                op.status = 'failed'
+                op.message = 'The worker carrying out the operation was lost'
+
+    for op_id in resent:
+        provision_jurisdiction.delay(op_id)
 
 
 @mq.task
-def monitor_decommission(jurisdiction_id, nodes_stack_id, net_stack_id):
+def monitor_decommission(snapshot, checks=0):
     """
     Monitor the cluster node stack deletion. Once it's complete, trigger the
     deletion of the cluster network stack.
     """
-    with db.transaction() as session:
-        j = session.query(Jurisdiction).filter_by(id=jurisdiction_id).one()
-        region = j.parent.parent.configuration['region']
-        cf_client = boto3.client('cloudformation', region_name=region)
-
-        deletion_complete = False
-        checks = 0
-        while not deletion_complete:
-            time.sleep(30)
-            if j.parent.parent.configuration['platform'] == 'amazon_web_services':
-                node_stack = cf_client.describe_stacks(StackName=nodes_stack_id)
-                status = node_stack['Stacks'][0]['StackStatus']
-                if status == 'DELETE_COMPLETE':
-                    cf_client.delete_stack(StackName=net_stack_id)
-                    deletion_complete = True
-                elif status[-6:] == 'FAILED':
-                    deletion_complete = True
-                checks += 1
-                if checks > 30:
-                    deletion_complete = True
+    j = JurisdictionSnapshot.from_dict(snapshot)
+    if j.configuration['platform'] != 'amazon_web_services':
+        return
 
+    cf_client = aws_clients.get('cloudformation', j.region)
+    node_stack = cf_client.describe_stacks(StackName=j.stacks['nodes'])
+    status = node_stack['Stacks'][0]['StackStatus']
+    if status == 'DELETE_COMPLETE':
+        cf_client.delete_stack(StackName=j.stacks['network'])
+    elif status[-6:] != 'FAILED' and checks < MAX_CHECKS:
+        poll_later(monitor_decommission, snapshot, checks=checks + 1)
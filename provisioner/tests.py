@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import datetime
+import json
 import os
 import time
 import unittest
@@ -6,6 +8,7 @@ from subprocess import call, check_output, CalledProcessError
 
 import boto3
 import falcon
+import sqlalchemy
 
 
 class TestProvisioner(unittest.TestCase):
@@ -50,6 +53,26 @@ class TestProvisioner(unittest.TestCase):
 
         os.environ['POSTGRES_DB'] = existing_db_name
 
+    def test_migrations(self):
+        # setUp created and migrated a fresh database
+        with db.transaction() as session:
+            applied = [v for v, in session.query(models.SchemaMigration.version)
+                                          .order_by(models.SchemaMigration.version)]
+        self.assertEqual(sorted(m[0] for m in migrations.MIGRATIONS), applied)
+
+        # migrating again applies nothing
+        db.migrate()
+
+        # and every step can be applied again to the migrated schema
+        with db.engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                for version, description, steps in migrations.MIGRATIONS:
+                    for step in steps:
+                        database.apply_migration_step(connection, step)
+            finally:
+                transaction.rollback()
+
     def test_jurisdiction_types(self):
         # request non-existent
         self.assertRaises(falcon.errors.HTTPBadRequest,
@@ -80,7 +103,349 @@ class TestProvisioner(unittest.TestCase):
             self.assertListEqual([prov_defaults['configuration_templates'][x]],
                                  api.get_configuration_templates(configuration_template_id=x+1)['data'])
 
+    def test_create_jurisdictions(self):
+        specs = [
+            {
+                'jurisdiction_name': 'bulk_control_group',
+                'jurisdiction_type_id': 1,
+                'configuration_template_id': 1
+            },
+            {
+                'jurisdiction_name': 'bulk_cluster',
+                'jurisdiction_type_id': 3,
+                'configuration_template_id': 3,
+                'parent_name': 'bulk_tier'
+            },
+            {
+                'jurisdiction_name': 'bulk_tier',
+                'jurisdiction_type_id': 2,
+                'configuration_template_id': 2,
+                'parent_name': 'bulk_control_group'
+            }
+        ]
+
+        # mismatched template creates nothing
+        bad_specs = [dict(s) for s in specs]
+        bad_specs[2]['configuration_template_id'] = 1
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.create_jurisdictions,
+                          body=bad_specs)
+        self.assertListEqual([], api.get_jurisdictions()['data'])
+
+        # values of the wrong type are rejected before reaching the database
+        for key, value in (('jurisdiction_type_id', '2'),
+                           ('configuration_template_id', None),
+                           ('parent_name', 1)):
+            bad_specs = [dict(s) for s in specs]
+            bad_specs[2][key] = value
+            self.assertRaises(falcon.errors.HTTPBadRequest,
+                              api.create_jurisdictions,
+                              body=bad_specs)
+
+        # as is a parent given both by id and by name
+        bad_specs = [dict(s) for s in specs]
+        bad_specs[2]['parent_id'] = 1
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.create_jurisdictions,
+                          body=bad_specs)
+        self.assertListEqual([], api.get_jurisdictions()['data'])
+
+        # successful creation
+        created = api.create_jurisdictions(body=specs)['data']
+        self.assertEqual([s['jurisdiction_name'] for s in specs],
+                         [j['name'] for j in created])
+        ids = {j['name']: j['id'] for j in created}
+        self.assertIsNone(created[0]['parent_id'])
+        self.assertEqual(ids['bulk_tier'], created[1]['parent_id'])
+        self.assertEqual(ids['bulk_control_group'], created[2]['parent_id'])
+
+        # ancestry is materialized as jurisdictions are created
+        with db.transaction() as session:
+            cluster = session.query(models.Jurisdiction).get(ids['bulk_cluster'])
+            self.assertEqual(['bulk_control_group', 'bulk_tier', 'bulk_cluster'],
+                             [j.name for j in cluster.lineage()])
+            control_group = cluster.ancestors()[0]
+            self.assertEqual(['bulk_tier', 'bulk_cluster'],
+                             [j.name for j in control_group.descendants()])
+
+        # lineage, parents and types are loaded up front in one query
+        with db.transaction() as session:
+            cluster = models.Jurisdiction.load_with_lineage(session, ids['bulk_cluster'])
+            self.assertEqual('bulk_tier', cluster.parent.name)
+            self.assertEqual('bulk_control_group', cluster.parent.parent.name)
+            self.assertEqual('cluster', cluster.jurisdiction_type.name)
+            self.assertRaises(sqlalchemy.exc.InvalidRequestError,
+                              lambda: cluster.children)
+            snapshot = cluster.snapshot()
+
+            # nested values are copies, never shared with the jurisdiction
+            cidrs = list(cluster.configuration['host_subnet_cidrs'])
+            cluster.snapshot().configuration['host_subnet_cidrs'].append('10.0.0.0/8')
+            self.assertEqual(cidrs, cluster.configuration['host_subnet_cidrs'])
+            self.assertEqual(cidrs, snapshot.configuration['host_subnet_cidrs'])
+
+        # snapshots resolve configuration and survive serialization
+        self.assertEqual('cluster', snapshot.type)
+        self.assertEqual(prov_defaults['configuration_templates'][0]['configuration']['region'],
+                         snapshot.region)
+        self.assertEqual(['bulk_control_group', 'bulk_tier', 'bulk_cluster'],
+                         [ref.name for ref in snapshot.lineage])
+        self.assertIn('dedicated_etcd', snapshot.configuration)
+        self.assertEqual(snapshot.as_dict(),
+                         models.JurisdictionSnapshot.from_dict(
+                             json.loads(json.dumps(snapshot.as_dict()))).as_dict())
+        self.assertRaises(AttributeError, setattr, snapshot, 'name', 'renamed')
+
+        # a jurisdiction's configuration values override its ancestors', so
+        # the tier's cidrs override the control group's and a cluster value
+        # overrides the tier's
+        tier_configuration = prov_defaults['configuration_templates'][1]['configuration']
+        self.assertEqual(tier_configuration['primary_cluster_cidr'],
+                         snapshot.configuration['primary_cluster_cidr'])
+        api.patch_jurisdiction_configuration(jurisdiction_id=ids['bulk_cluster'],
+                                             body={'worker_instance_type': 'overridden'})
+        with db.transaction() as session:
+            snapshot = models.Jurisdiction.load_with_lineage(session, ids['bulk_cluster'])\
+                                          .snapshot()
+        self.assertEqual('overridden', snapshot.configuration['worker_instance_type'])
+
+        # existing names are rejected
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.create_jurisdictions,
+                          body=specs[:1])
+
+    def test_concurrent_updates(self):
+        j_id = api.create_jurisdiction(jurisdiction_name='versioned_control_group',
+                                       jurisdiction_type_id=1,
+                                       configuration_template_id=1)['data']['id']
+        attempts = []
+
+        @db.retried(retries=1)
+        def set_assets(session, assets):
+            j = session.query(models.Jurisdiction).get(j_id)
+            attempts.append(j.version)
+            if len(attempts) == 1:
+                # a concurrent update after the jurisdiction was loaded
+                api.edit_jurisdiction(jurisdiction_id=j_id,
+                                      **{'name': 'versioned_edit'})
+            j.assets = assets
+
+        set_assets({'s3_bucket': 'versioned'})
+        self.assertEqual(2, len(attempts))
+        self.assertEqual(attempts[0] + 1, attempts[1])
+        j = api.get_jurisdictions(jurisdiction_id=j_id)['data'][0]
+        self.assertEqual('versioned_edit', j['name'])
+        self.assertEqual({'s3_bucket': 'versioned'}, j['assets'])
+
+    def test_watch_cursors(self):
+        first_id, second_id = [api.create_jurisdiction(jurisdiction_name=name,
+                                                       jurisdiction_type_id=1,
+                                                       configuration_template_id=1)['data']['id']
+                               for name in ('watched_first', 'watched_second')]
+        cursor = api.watch_jurisdictions()['cursor']
+
+        # the first change commits after the second and after a cursor is
+        # handed out that includes the second
+        with db.transaction() as session:
+            session.query(models.Jurisdiction).filter_by(id=first_id)\
+                   .update({'active': True}, synchronize_session=False)
+            api.patch_jurisdiction_configuration(jurisdiction_id=second_id,
+                                                 body={'initial_workers': 2})
+            changes = api.watch_jurisdictions(since=cursor, timeout=0)
+            self.assertEqual([second_id], [c['id'] for c in changes['data']])
+            cursor = changes['cursor']
+
+        changes = api.watch_jurisdictions(since=cursor, timeout=0)
+        self.assertEqual([first_id], [c['id'] for c in changes['data']])
+        self.assertTrue(changes['data'][0]['active'])
+        changes = api.watch_jurisdictions(since=changes['cursor'], timeout=0)
+        self.assertEqual([], changes['data'])
+
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.watch_jurisdictions,
+                          since='2017-01-01T00:00:00')
+
+    def test_change_feeds(self):
+        # waiters share the process's one listening connection
+        with db.listen('test_channel') as first, db.listen('test_channel') as second:
+            with db.transaction() as session:
+                db.notify(session, 'test_channel', {'payload': 1})
+            self.assertEqual([{'payload': 1}], first.wait(5))
+            self.assertEqual([{'payload': 1}], second.wait(5))
+            self.assertEqual([], first.wait(0))
+
+            # a payload that isn't JSON is dropped without losing the others
+            with db.transaction() as session:
+                session.execute("SELECT pg_notify('test_channel', 'not json')")
+                db.notify(session, 'test_channel', {'payload': 2})
+            self.assertEqual([{'payload': 2}], first.wait(5))
+
+    def test_jurisdiction_locks(self):
+        j_id = api.create_jurisdiction(jurisdiction_name='locked_control_group',
+                                       jurisdiction_type_id=1,
+                                       configuration_template_id=1)['data']['id']
+
+        with db.transaction() as session:
+            self.assertTrue(db.try_lock_jurisdiction(session, j_id))
+            self.assertRaises(falcon.errors.HTTPConflict,
+                              api.provision_jurisdiction,
+                              jurisdiction_id=j_id)
+            self.assertRaises(falcon.errors.HTTPConflict,
+                              api.decommission_jurisdiction,
+                              jurisdiction_id=j_id)
+            with db.transaction() as other_session:
+                self.assertFalse(db.try_lock_jurisdiction(other_session, j_id))
+                self.assertTrue(db.try_lock_jurisdiction(other_session, j_id + 1))
+
+        # released when the transaction ends
+        with db.transaction() as session:
+            self.assertTrue(db.try_lock_jurisdiction(session, j_id))
+
+        # stacks still being created also conflict
+        with db.transaction() as session:
+            session.add(models.Stack(jurisdiction_id=j_id, stack_id='locked_stack',
+                                     region='us-east-2', status='CREATE_IN_PROGRESS'))
+        self.assertRaises(falcon.errors.HTTPConflict,
+                          api.provision_jurisdiction,
+                          jurisdiction_id=j_id)
+
+    def test_stuck_operations(self):
+        j_id = api.create_jurisdiction(jurisdiction_name='stuck_control_group',
+                                       jurisdiction_type_id=1,
+                                       configuration_template_id=1)['data']['id']
+        stale = datetime.datetime.utcnow() - \
+                datetime.timedelta(seconds=tasks.OPERATION_TIMEOUT + 1)
+        with db.transaction() as session:
+            lost = models.Operation(action='provision', status='running',
+                                    jurisdiction_id=j_id)
+            started = models.Operation(action='provision', status='running',
+                                       jurisdiction_id=j_id)
+            recent = models.Operation(action='provision', status='running',
+                                      jurisdiction_id=j_id)
+            session.add_all([lost, started, recent])
+            session.flush()
+            tasks.start_workflow(session, j_id, 'provision_cluster', started.id)
+            session.flush()
+            session.query(models.Operation)\
+                   .filter(models.Operation.id.in_([lost.id, started.id]))\
+                   .update({'updated_on': stale}, synchronize_session=False)
+            op_ids = [lost.id, started.id, recent.id]
+
+        # a running operation is failed if its worker was lost before its
+        # workflow started and complete if it was lost after
+        tasks.resume_operations()
+        with db.transaction() as session:
+            self.assertEqual(['failed', 'complete', 'running'],
+                             [session.query(models.Operation).get(op_id).status
+                              for op_id in op_ids])
+
+    def test_stack_events(self):
+        j_id = api.create_jurisdiction(jurisdiction_name='evented_control_group',
+                                       jurisdiction_type_id=1,
+                                       configuration_template_id=1)['data']['id']
+        stack_id = 'arn:aws:cloudformation:us-east-2:123456789012:stack/' \
+                   'ControlGroup{}/1'.format(j_id)
+        with db.transaction() as session:
+            session.add(models.Stack(jurisdiction_id=j_id, stack_id=stack_id,
+                                     region='us-east-2'))
+
+        events_file = '/tmp/test_stack_events'
+        queue = events.FileEventQueue(events_file)
+        # published out of order, within a drain and across drains
+        queue.publish(stack_id, 'CREATE_COMPLETE', '2017-01-01T00:00:02.000Z')
+        queue.publish(stack_id, 'CREATE_IN_PROGRESS', '2017-01-01T00:00:01.000Z')
+
+        # nothing is drained without a queue
+        tasks.consume_stack_events()
+
+        os.environ['STACK_EVENTS_FILE'] = events_file
+        try:
+            tasks.consume_stack_events()
+            self.assertEqual(queue.receive(), [])
+            queue.publish(stack_id, 'CREATE_IN_PROGRESS', '2017-01-01T00:00:00.000Z')
+            tasks.consume_stack_events()
+            self.assertEqual(queue.receive(), [])
+        finally:
+            del os.environ['STACK_EVENTS_FILE']
+            os.remove(events_file)
+            os.remove(queue.offset_path)
+
+        with db.transaction() as session:
+            stack = session.query(models.Stack).filter_by(jurisdiction_id=j_id).one()
+            self.assertEqual(stack.status, 'CREATE_COMPLETE')
+            self.assertTrue(session.query(models.Jurisdiction).get(j_id).active)
+
+        # a stack unknown to cloudformation is swept as deleted rather than
+        # failing the sweep of its region
+        self.assertEqual({stack_id: 'DELETE_COMPLETE'},
+                         tasks.cloudformation_statuses('us-east-2', [stack_id]))
+
+        # a sweep that listed the stack before its last event is ignored too
+        with db.transaction() as session:
+            self.assertEqual([], tasks.record_stack_statuses(
+                session, {stack_id: ('CREATE_IN_PROGRESS', '2017-01-01T00:00:01.500Z')}))
+            changed = tasks.record_stack_statuses(
+                session, {stack_id: ('DELETE_IN_PROGRESS', events.utc_timestamp())})
+            self.assertEqual([(j_id, models.Stack.MAIN, 'DELETE_IN_PROGRESS')],
+                             [tuple(s) for s in changed])
+
+    def test_workflow_steps(self):
+        j_id = api.create_jurisdiction(jurisdiction_name='workflow_control_group',
+                                       jurisdiction_type_id=1,
+                                       configuration_template_id=1)['data']['id']
+
+        with db.transaction() as session:
+            op = models.Operation(action='provision', status='complete', jurisdiction_id=j_id)
+            session.add(op)
+            session.flush()
+            tasks.start_workflow(session, j_id, 'provision_cluster', op.id)
+            session.flush()
+            steps = session.query(models.WorkflowStep)\
+                           .filter_by(jurisdiction_id=j_id)\
+                           .order_by(models.WorkflowStep.id).all()
+            self.assertEqual(['network', 'nodes', 'register_elb_instances', 'activate'],
+                             [s.name for s in steps])
+
+            # a workflow that is still running is never restarted
+            self.assertRaises(RuntimeError, tasks.start_workflow,
+                              session, j_id, 'provision_cluster')
+
+            # each step starts once, when the step it depends on completes
+            self.assertEqual([steps[0].id], tasks.advance_steps(steps, {}))
+            self.assertEqual([], tasks.advance_steps(steps, {'network': 'CREATE_IN_PROGRESS'}))
+            self.assertEqual([steps[1].id], tasks.advance_steps(steps, {'network': 'CREATE_COMPLETE'}))
+            self.assertEqual([], tasks.advance_steps(steps, {'network': 'CREATE_COMPLETE',
+                                                             'nodes': 'ROLLBACK_COMPLETE'}))
+            self.assertEqual(['complete', 'failed', 'waiting', 'waiting'],
+                             [s.status for s in steps])
+
+            # the operation that started the workflow fails with the step
+            tasks.fail_operations(session, steps)
+            session.refresh(op)
+            self.assertEqual('failed', op.status)
+            self.assertEqual('Step nodes of workflow provision_cluster failed: '
+                             'Stack nodes is ROLLBACK_COMPLETE', op.message)
+
+            # restarting the workflow once it has failed replaces its steps
+            session.flush()
+            tasks.start_workflow(session, j_id, 'provision_cluster')
+            session.flush()
+            self.assertEqual(['waiting'] * 4,
+                             [s.status for s, in session.query(models.WorkflowStep.status)
+                                                        .filter_by(jurisdiction_id=j_id)])
+
+        # the jurisdiction can't be provisioned again while its workflow runs
+        self.assertRaises(falcon.errors.HTTPConflict,
+                          api.provision_jurisdiction,
+                          jurisdiction_id=j_id)
+
     def test_jurisdictions(self):
+        def effective_configuration(*template_indexes):
+            configuration = {}
+            for i in template_indexes:
+                configuration.update(prov_defaults['configuration_templates'][i]['configuration'])
+            return configuration
+
         test_cg = {
             'id': 1,
             'name': 'test_control_group',
@@ -89,6 +454,7 @@ class TestProvisioner(unittest.TestCase):
             'assets': None,
             'metadata': None,
             'configuration': prov_defaults['configuration_templates'][0]['configuration'],
+            'effective_configuration': effective_configuration(0),
             'jurisdiction_type_id': 1,
             'parent_id': None
         }
@@ -100,6 +466,7 @@ class TestProvisioner(unittest.TestCase):
             'assets': None,
             'metadata': None,
             'configuration': prov_defaults['configuration_templates'][1]['configuration'],
+            'effective_configuration': effective_configuration(0, 1),
             'jurisdiction_type_id': 2,
             'parent_id': 1
         }
@@ -111,6 +478,7 @@ class TestProvisioner(unittest.TestCase):
             'assets': None,
             'metadata': None,
             'configuration': prov_defaults['configuration_templates'][2]['configuration'],
+            'effective_configuration': effective_configuration(0, 1, 2),
             'jurisdiction_type_id': 3,
             'parent_id': 2
         }
@@ -119,19 +487,16 @@ class TestProvisioner(unittest.TestCase):
         cf_client = boto3.client('cloudformation', region_name=test_cg['configuration']['region'])
 
         def jurisdiction_active(jurisdiction_id):
-            check_attempts = 0
-            active = False
-            while not active:
-                j = api.get_jurisdictions(jurisdiction_id=jurisdiction_id)
-                if not j['data'][0]['active']:
-                    if check_attempts < 30:
-                        time.sleep(30)
-                        check_attempts += 1
-                        continue
-                    else:
-                        return False
-                else:
-                    return True
+            cursor = None
+            for check_attempts in range(30):
+                changes = api.watch_jurisdictions(jurisdiction_id=jurisdiction_id,
+                                                  since=cursor,
+                                                  timeout=30)
+                cursor = changes['cursor']
+                for j in changes['data']:
+                    if j['active']:
+                        return True
+            return False
 
         def stack_id_exists(stack_id):
             stacks = cf_client.list_stacks()
@@ -143,6 +508,19 @@ class TestProvisioner(unittest.TestCase):
             else:
                 return False
 
+        def provision(jurisdiction_id):
+            op = api.provision_jurisdiction(jurisdiction_id=jurisdiction_id)
+            self.assertEqual('pending', op['data']['status'])
+            check_attempts = 0
+            while op['data']['status'] in ('pending', 'running'):
+                self.assertLess(check_attempts, 30)
+                time.sleep(5)
+                check_attempts += 1
+                op = api.get_operation(operation_id=op['data']['id'])
+            self.assertEqual('complete', op['data']['status'])
+            j = api.get_jurisdictions(jurisdiction_id=jurisdiction_id)
+            return {'data': j['data'][0]}
+
         # create control group
         create_cg_resp = api.create_jurisdiction(
                             jurisdiction_name=test_cg['name'],
@@ -180,6 +558,42 @@ class TestProvisioner(unittest.TestCase):
             j['created_on'] = None
         self.assertListEqual(test_jurisdictions, all_j['data'])
 
+        # request pages
+        first_page = api.get_jurisdictions(limit=2)
+        self.assertEqual([1, 2], [j['id'] for j in first_page['data']])
+        self.assertEqual(2, first_page['next_after_id'])
+        last_page = api.get_jurisdictions(limit=2,
+                                          after_id=first_page['next_after_id'])
+        self.assertEqual([3], [j['id'] for j in last_page['data']])
+        self.assertIsNone(last_page['next_after_id'])
+        for bad_limit in (0, -1):
+            self.assertRaises(falcon.errors.HTTPBadRequest,
+                              api.get_jurisdictions,
+                              limit=bad_limit)
+
+        # request projected fields
+        projected_j = api.get_jurisdictions(fields=['name', 'active'])
+        self.assertListEqual(
+            [{'id': j['id'], 'name': j['name'], 'active': j['active']}
+             for j in test_jurisdictions],
+            projected_j['data'])
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.get_jurisdictions,
+                          fields=['bogus'])
+
+        # request subtrees
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.get_jurisdiction_tree,
+                          jurisdiction_id=99999)
+        tree = api.get_jurisdiction_tree(jurisdiction_id=1)
+        self.assertEqual([(1, 0), (2, 1), (3, 2)],
+                         [(j['id'], j['depth']) for j in tree['data']])
+        tree = api.get_jurisdiction_tree(jurisdiction_id=1, depth=1)
+        self.assertEqual([1, 2], [j['id'] for j in tree['data']])
+        tree = api.get_jurisdiction_tree(jurisdiction_id=1,
+                                         jurisdiction_type_id=3)
+        self.assertEqual([3], [j['id'] for j in tree['data']])
+
         # request particulars
         for test_j in test_jurisdictions:
             j = api.get_jurisdictions(jurisdiction_id=int(test_j['id']))
@@ -199,13 +613,36 @@ class TestProvisioner(unittest.TestCase):
             j['data']['created_on'] = None
             self.assertDictEqual(test_j, j['data'])
 
+        # configuration patches
+        self.assertRaises(falcon.errors.HTTPBadRequest,
+                          api.patch_jurisdiction_configuration,
+                          jurisdiction_id=99999, body={'initial_workers': 3})
+        j = api.patch_jurisdiction_configuration(
+                jurisdiction_id=2,
+                body={'initial_workers': 3, 'test_key': {'a': 1, 'b': None}})
+        self.assertEqual(3, j['data']['configuration']['initial_workers'])
+        self.assertDictEqual({'a': 1}, j['data']['configuration']['test_key'])
+        j = api.patch_jurisdiction_configuration(
+                jurisdiction_id=2,
+                body={'test_key': {'a': None, 'c': [1, 2]}})
+        self.assertDictEqual({'c': [1, 2]}, j['data']['configuration']['test_key'])
+        self.assertDictEqual({'c': [1, 2]}, j['data']['effective_configuration']['test_key'])
+        cluster = api.get_jurisdictions(jurisdiction_id=3)['data'][0]
+        self.assertEqual(3, cluster['effective_configuration']['initial_workers'])
+        self.assertDictEqual({'c': [1, 2]}, cluster['effective_configuration']['test_key'])
+        j = api.patch_jurisdiction_configuration(
+                jurisdiction_id=2,
+                body={'initial_workers': 2, 'test_key': None})
+        j['data']['created_on'] = None
+        self.assertDictEqual(test_tier, j['data'])
+
         # provision tier without control group
         self.assertRaises(falcon.errors.HTTPBadRequest,
                           api.provision_jurisdiction,
                           jurisdiction_id=2)
 
         # succuessful control group provision
-        prov_cg = api.provision_jurisdiction(jurisdiction_id=1)
+        prov_cg = provision(1)
         self.assertTrue(isinstance(
             prov_cg['data']['assets']['cloudformation_stack']['stack_id'],
             str
@@ -218,7 +655,7 @@ class TestProvisioner(unittest.TestCase):
         self.assertTrue(jurisdiction_active(prov_cg['data']['id']))
 
         # successful tier provision
-        prov_tier = api.provision_jurisdiction(jurisdiction_id=2)
+        prov_tier = provision(2)
         self.assertTrue(isinstance(
             prov_tier['data']['assets']['cloudformation_stack']['stack_id'],
             str
@@ -230,8 +667,13 @@ class TestProvisioner(unittest.TestCase):
         # ensure tier activates
         self.assertTrue(jurisdiction_active(prov_tier['data']['id']))
 
-        # successful cluster provision
-        prov_cluster = api.provision_jurisdiction(jurisdiction_id=3)
+        # successful cluster provision, whose stacks are created by the
+        # provision_cluster workflow after the operation completes
+        provision(3)
+
+        # ensure cluster activates
+        self.assertTrue(jurisdiction_active(3))
+        prov_cluster = {'data': api.get_jurisdictions(jurisdiction_id=3)['data'][0]}
         self.assertTrue(isinstance(
             prov_cluster['data']['assets']['cloudformation_stack']['network']['stack_id'],
             str
@@ -239,9 +681,11 @@ class TestProvisioner(unittest.TestCase):
         self.assertTrue(stack_id_exists(
             prov_cluster['data']['assets']['cloudformation_stack']['network']['stack_id']#,
         ))
-
-        # ensure cluster activates
-        self.assertTrue(jurisdiction_active(prov_cluster['data']['id']))
+        with db.transaction() as session:
+            self.assertEqual(['complete'] * 4,
+                             [s.status for s in session.query(models.WorkflowStep)
+                                                       .filter_by(jurisdiction_id=3)
+                                                       .order_by(models.WorkflowStep.id)])
 
         # attempt to decommission tier with active cluster
         self.assertRaises(falcon.errors.HTTPBadRequest,
@@ -318,9 +762,15 @@ class TestProvisioner(unittest.TestCase):
 if __name__ == '__main__':
     existing_db_name = os.environ.get('POSTGRES_DB')
     os.environ['POSTGRES_DB'] = os.environ.get('TEST_POSTGRES_DB')
+    os.environ['RAISE_ON_LAZY_LOAD'] = 'true'
     from provisioner import api
+    from provisioner import database
     from provisioner import db
     from provisioner import defaults
+    from provisioner import events
+    from provisioner import migrations
+    from provisioner import models
+    from provisioner import tasks
     from provisioner.defaults import PROVISIONER_DEFAULTS as prov_defaults
     unittest.main()
 
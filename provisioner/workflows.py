@@ -0,0 +1,27 @@
+"""
+Declarative definitions of workflows that carry out an operation in steps.
+
+A workflow is a sequence of steps, each with a name, the names of the steps
+it depends on, the name of its action in provisioner.tasks.STEP_ACTIONS and
+the key of the stack its action creates, if any. The steps of a workflow are
+saved as WorkflowSteps when it is started and advance_workflow starts each
+step once those it depends on are complete. A step is complete when its
+action returns or, if it creates a stack, once the stack is created.
+"""
+from collections import namedtuple
+
+
+Step = namedtuple('Step', ('name', 'depends_on', 'action', 'stack_key'))
+
+WORKFLOWS = {
+    'provision_cluster': (
+        Step('network', (), 'provision_cluster_network', 'network'),
+        Step('nodes', ('network',), 'provision_cluster_nodes', 'nodes'),
+        Step('register_elb_instances', ('nodes',), 'register_elb_instances', None),
+        Step('activate', ('register_elb_instances',), 'activate_jurisdiction', None)
+    )
+}
+
+# keys of the stacks whose status changes advance workflows
+WORKFLOW_STACK_KEYS = frozenset(step.stack_key for steps in WORKFLOWS.values()
+                                for step in steps if step.stack_key)